@@ -0,0 +1,89 @@
+from typing import Any, List
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+
+from app.api.schemas import CategoryRule, CategoryRuleCreate
+from app.db.session import get_db
+from app.db.models import CategoryRule as CategoryRuleModel, User
+from app.api.dependencies import get_current_active_user
+from app.email.user_rules import normalize_rule_value, user_rule_cache
+
+router = APIRouter()
+
+@router.get("", response_model=List[CategoryRule])
+async def read_category_rules(
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user),
+) -> Any:
+    """
+    Retrieve the current user's category rules in evaluation order.
+    """
+    query = select(CategoryRuleModel).where(
+        CategoryRuleModel.user_id == current_user.id
+    ).order_by(CategoryRuleModel.created_at, CategoryRuleModel.id)
+    result = await db.execute(query)
+    return result.scalars().all()
+
+@router.post("", response_model=CategoryRule)
+async def create_category_rule(
+    rule_in: CategoryRuleCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user),
+) -> Any:
+    """
+    Create a category rule applied to newly synced emails.
+    """
+    value = normalize_rule_value(rule_in.rule_type, rule_in.value)
+    if not value:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Rule value is empty",
+        )
+    if rule_in.rule_type == "header" and not (rule_in.header_name or "").strip():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Header rules need a header name",
+        )
+    
+    rule = CategoryRuleModel(
+        user_id=current_user.id,
+        rule_type=rule_in.rule_type,
+        value=value,
+        header_name=rule_in.header_name.strip().lower() if rule_in.rule_type == "header" else None,
+        category=rule_in.category
+    )
+    db.add(rule)
+    await db.commit()
+    await db.refresh(rule)
+    
+    user_rule_cache.invalidate(current_user.id)
+    return rule
+
+@router.delete("/{rule_id}", response_model=CategoryRule)
+async def delete_category_rule(
+    rule_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user),
+) -> Any:
+    """
+    Delete a category rule.
+    """
+    query = select(CategoryRuleModel).where(
+        CategoryRuleModel.id == rule_id,
+        CategoryRuleModel.user_id == current_user.id
+    )
+    result = await db.execute(query)
+    rule = result.scalars().first()
+    if not rule:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Category rule not found",
+        )
+    
+    await db.delete(rule)
+    await db.commit()
+    
+    user_rule_cache.invalidate(current_user.id)
+    return rule
@@ -1,21 +1,25 @@
 from typing import Any, List
 
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
-from app.api.schemas import EmailAccount, EmailAccountCreate, BulkEmailImport
+from app.api.schemas import EmailAccount, EmailAccountCreate, BulkEmailImport, SyncStatus
 from app.db.session import get_db
-from app.db.models import EmailAccount as EmailAccountModel, User
+from app.db.models import EmailAccount as EmailAccountModel, Email as EmailModel, Attachment as AttachmentModel, User
 from app.api.dependencies import get_current_active_user
-from app.email.service import fetch_emails_for_account
+from app.email.idle import idle_manager
+from app.email.metrics import sync_lag
+from app.email.jobs import enqueue_sync, get_sync_status
+from app.email.scheduler import PRIORITY_HIGH
+from app.email.service import token_cache
+from app.email.writer import release_attachment_files
 
 router = APIRouter()
 
 @router.post("", response_model=EmailAccount)
 async def create_email_account(
     email_account_in: EmailAccountCreate,
-    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
 ) -> Any:
@@ -45,19 +49,14 @@ async def create_email_account(
     await db.commit()
     await db.refresh(email_account)
     
-    # Schedule background task to fetch emails
-    background_tasks.add_task(
-        fetch_emails_for_account,
-        account_id=email_account.id,
-        user_id=current_user.id
-    )
+    # Queue the first sync for the sync worker
+    await enqueue_sync(db, email_account.id, current_user.id, PRIORITY_HIGH)
     
     return email_account
 
 @router.post("/bulk-import", response_model=List[EmailAccount])
 async def bulk_import_email_accounts(
     bulk_import: BulkEmailImport,
-    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
 ) -> Any:
@@ -75,10 +74,10 @@ async def bulk_import_email_accounts(
                 parts = account_str.split('----')
             else:
                 continue
-                
+            
             if len(parts) != 4:
                 continue
-                
+            
             email_address, password, refresh_token, client_id = parts
             
             # Check if this email account already exists for this user
@@ -101,12 +100,8 @@ async def bulk_import_email_accounts(
             await db.commit()
             await db.refresh(email_account)
             
-            # Schedule background task to fetch emails
-            background_tasks.add_task(
-                fetch_emails_for_account,
-                account_id=email_account.id,
-                user_id=current_user.id
-            )
+            # Queue the first sync for the sync worker
+            await enqueue_sync(db, email_account.id, current_user.id)
             
             created_accounts.append(email_account)
         except Exception:
@@ -175,19 +170,32 @@ async def delete_email_account(
             detail="Email account not found",
         )
     
+    # Remember the attachment files so the ones only this account used can be removed
+    attachments_query = select(AttachmentModel.file_path, AttachmentModel.content_hash).join(
+        EmailModel, AttachmentModel.email_id == EmailModel.id
+    ).where(EmailModel.email_account_id == account.id)
+    result = await db.execute(attachments_query)
+    attachment_files = result.all()
+    
     await db.delete(account)
     await db.commit()
+    await release_attachment_files(db, attachment_files)
+    token_cache.discard(account.id)
+    sync_lag.forget(account.id)
+    await idle_manager.unwatch(account.id)
     return account
 
-@router.post("/{account_id}/sync", response_model=EmailAccount)
+@router.post("/{account_id}/sync", response_model=SyncStatus)
 async def sync_email_account(
     account_id: str,
-    background_tasks: BackgroundTasks,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_active_user),
 ) -> Any:
     """
     Manually trigger a sync for an email account.
+    
+    Repeated requests while a sync is queued join it, and requests while one
+    is running queue a single follow-up sync. Returns the sync status.
     """
     query = select(EmailAccountModel).where(
         EmailAccountModel.id == account_id,
@@ -201,11 +209,30 @@ async def sync_email_account(
             detail="Email account not found",
         )
     
-    # Trigger background task to fetch emails
-    background_tasks.add_task(
-        fetch_emails_for_account,
-        account_id=account.id,
-        user_id=current_user.id
+    # Queue a sync ahead of scheduled ones
+    await enqueue_sync(db, account.id, current_user.id, PRIORITY_HIGH)
+    
+    return {**await get_sync_status(db, account.id), "last_sync": account.last_sync}
+
+@router.get("/{account_id}/sync", response_model=SyncStatus)
+async def get_email_account_sync_status(
+    account_id: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user),
+) -> Any:
+    """
+    Get the sync status of an email account.
+    """
+    query = select(EmailAccountModel).where(
+        EmailAccountModel.id == account_id,
+        EmailAccountModel.user_id == current_user.id
     )
+    result = await db.execute(query)
+    account = result.scalars().first()
+    if not account:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Email account not found",
+        )
     
-    return account 
\ No newline at end of file
+    return {**await get_sync_status(db, account.id), "last_sync": account.last_sync} 
\ No newline at end of file
@@ -1,13 +1,22 @@
-from typing import Any, List
+import asyncio
+import logging
+import os
+import stat
+from typing import Any, Dict, List
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response, status
+from fastapi.responses import FileResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_
 
 from app.api.schemas import Email
 from app.db.session import get_db
 from app.db.models import Email as EmailModel, EmailAccount as EmailAccountModel, User, Attachment
-from app.api.dependencies import get_current_active_user
+from app.api.dependencies import get_current_active_user, get_current_active_admin
+from app.email.recategorize import queue_recategorization
+from app.email.service import load_email_body, retrain_classifier
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
@@ -51,7 +60,7 @@ async def read_emails(
     
     if is_read is not None:
         filters.append(EmailModel.is_read == is_read)
-        
+    
     if category:
         filters.append(EmailModel.category == category)
     
@@ -77,6 +86,9 @@ async def read_emails(
             "date_received": email.date_received,
             "body_text": email.body_text,
             "body_html": email.body_html,
+            "body_loaded": email.body_loaded is not False,
+            "has_attachments": bool(email.has_attachments),
+            "size": email.size,
             "is_read": email.is_read,
             "category": email.category,
             "created_at": email.created_at,
@@ -86,6 +98,56 @@ async def read_emails(
     
     return response_emails
 
+@router.post("/recategorize")
+async def recategorize_stored_emails(
+    account_id: str = None,
+    all_users: bool = False,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user),
+) -> Dict[str, str]:
+    """
+    Re-run categorization over stored emails of one account, all of the user's
+    accounts, or every user's emails (admins only). The job runs in a sync
+    worker; progress is sent over the WebSocket as recategorize_progress messages.
+    """
+    if all_users and not current_user.is_admin:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="The user doesn't have enough privileges",
+        )
+    
+    if account_id:
+        account_query = select(EmailAccountModel).where(EmailAccountModel.id == account_id)
+        if not current_user.is_admin:
+            account_query = account_query.where(EmailAccountModel.user_id == current_user.id)
+        result = await db.execute(account_query)
+        if not result.scalars().first():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Email account not found",
+            )
+    
+    user_id = None if all_users or account_id else current_user.id
+    job = await queue_recategorization(db, current_user.id, user_id=user_id, account_id=account_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Re-categorization is already running",
+        )
+    
+    return {"job_id": job.id, "status": "queued"}
+
+@router.post("/classifier/train")
+async def train_category_classifier(
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_active_admin),
+) -> Dict[str, str]:
+    """
+    Retrain the category classifier on stored emails and user corrections.
+    """
+    background_tasks.add_task(retrain_classifier)
+    return {"status": "started"}
+
 @router.get("/{email_id}", response_model=Email)
 async def read_email(
     email_id: str,
@@ -120,6 +182,19 @@ async def read_email(
             detail="Access to this email is not permitted",
         )
     
+    # Download the body and attachments of emails synced in header-only mode
+    if email.body_loaded is False:
+        try:
+            loaded = await load_email_body(email, db)
+        except Exception as e:
+            logger.error(f"Error loading body of email {email.id}: {str(e)}")
+            loaded = False
+        if not loaded:
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail="Failed to download email content from the mail server",
+            )
+    
     # Mark as read if not already
     if not email.is_read:
         email.is_read = True
@@ -141,6 +216,9 @@ async def read_email(
         "date_received": email.date_received,
         "body_text": email.body_text,
         "body_html": email.body_html,
+        "body_loaded": email.body_loaded is not False,
+        "has_attachments": bool(email.has_attachments),
+        "size": email.size,
         "is_read": email.is_read,
         "category": email.category,
         "created_at": email.created_at,
@@ -215,6 +293,9 @@ async def mark_email_as_read(
         "date_received": email.date_received,
         "body_text": email.body_text,
         "body_html": email.body_html,
+        "body_loaded": email.body_loaded is not False,
+        "has_attachments": bool(email.has_attachments),
+        "size": email.size,
         "is_read": email.is_read,
         "category": email.category,
         "created_at": email.created_at,
@@ -289,6 +370,9 @@ async def mark_email_as_unread(
         "date_received": email.date_received,
         "body_text": email.body_text,
         "body_html": email.body_html,
+        "body_loaded": email.body_loaded is not False,
+        "has_attachments": bool(email.has_attachments),
+        "size": email.size,
         "is_read": email.is_read,
         "category": email.category,
         "created_at": email.created_at,
@@ -343,8 +427,9 @@ async def update_email_category(
             detail="Access to this email is not permitted",
         )
     
-    # Update the category
+    # Update the category; re-categorization leaves it alone from now on
     email.category = category
+    email.category_manual = True
     await db.commit()
     await db.refresh(email)
     
@@ -364,6 +449,9 @@ async def update_email_category(
         "date_received": email.date_received,
         "body_text": email.body_text,
         "body_html": email.body_html,
+        "body_loaded": email.body_loaded is not False,
+        "has_attachments": bool(email.has_attachments),
+        "size": email.size,
         "is_read": email.is_read,
         "category": email.category,
         "created_at": email.created_at,
@@ -381,4 +469,91 @@ async def update_email_category(
         ]
     }
     
-    return email_dict 
\ No newline at end of file
+    return email_dict 
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check an If-None-Match header against an ETag using weak comparison"""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+@router.get("/{email_id}/attachments/{attachment_id}")
+async def download_attachment(
+    email_id: str,
+    attachment_id: str,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_active_user),
+) -> Any:
+    """
+    Download an attachment.
+    
+    The file is streamed from disk in chunks (or handed to the server with
+    pathsend when supported) and honours Range, If-Range and If-None-Match.
+    """
+    # First check if the email exists
+    email_query = select(EmailModel).where(EmailModel.id == email_id)
+    result = await db.execute(email_query)
+    email = result.scalars().first()
+    
+    if not email:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Email not found",
+        )
+    
+    # Then verify the user has access to this email's account
+    account_query = select(EmailAccountModel).where(
+        EmailAccountModel.id == email.email_account_id,
+        EmailAccountModel.user_id == current_user.id
+    )
+    result = await db.execute(account_query)
+    account = result.scalars().first()
+    
+    if not account:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Access to this email is not permitted",
+        )
+    
+    attachment_query = select(Attachment).where(
+        Attachment.id == attachment_id,
+        Attachment.email_id == email.id
+    )
+    result = await db.execute(attachment_query)
+    attachment = result.scalars().first()
+    
+    if not attachment:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Attachment not found",
+        )
+    
+    try:
+        stat_result = await asyncio.to_thread(os.stat, attachment.file_path)
+    except (OSError, TypeError):
+        stat_result = None
+    if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Attachment file not found",
+        )
+    
+    # Content-addressed files have a natural strong ETag; older files fall back to mtime and size
+    headers = {"cache-control": "private, no-cache"}
+    if attachment.content_hash:
+        etag = f'"{attachment.content_hash}"'
+        headers["etag"] = etag
+        
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    return FileResponse(
+        attachment.file_path,
+        media_type=attachment.content_type or None,
+        filename=attachment.filename,
+        headers=headers,
+        stat_result=stat_result,
+    )
@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Optional, List, Literal
 from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
 
@@ -56,6 +56,15 @@ class EmailAccountInDB(EmailAccountBase):
 class EmailAccount(EmailAccountInDB):
     pass
 
+class SyncStatus(BaseModel):
+    account_id: str
+    status: Literal["idle", "queued", "running"]
+    job_id: Optional[str] = None
+    attempts: int = 0
+    last_error: Optional[str] = None
+    follow_up_queued: bool = False
+    last_sync: Optional[datetime] = None
+
 # Email schemas
 class EmailBase(BaseModel):
     subject: Optional[str] = None
@@ -77,6 +86,9 @@ class EmailInDB(EmailBase):
     message_id: str
     body_text: Optional[str] = None
     body_html: Optional[str] = None
+    body_loaded: bool = True
+    has_attachments: bool = False
+    size: Optional[int] = None
     created_at: datetime
 
     class Config:
@@ -110,6 +122,27 @@ class Attachment(AttachmentInDB):
 # Update forward references
 Email.model_rebuild()
 
+# Category rule schemas
+class CategoryRuleBase(BaseModel):
+    rule_type: Literal["sender", "domain", "subject", "header"]
+    value: str = Field(..., min_length=1)
+    header_name: Optional[str] = None
+    category: str
+
+class CategoryRuleCreate(CategoryRuleBase):
+    pass
+
+class CategoryRuleInDB(CategoryRuleBase):
+    id: str
+    user_id: str
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class CategoryRule(CategoryRuleInDB):
+    pass
+
 # Bulk import schema
 class BulkEmailImport(BaseModel):
     email_accounts: List[str] = Field(..., description="List of email accounts in the format 'email----password----refreshToken----clientId' where '----' is the separator") 
\ No newline at end of file
@@ -20,5 +20,75 @@ class Settings(BaseModel):
     
     # First user is admin
     FIRST_USER_IS_ADMIN: bool = True
+    
+    # OAuth access tokens are refreshed this many seconds before they expire
+    TOKEN_REFRESH_MARGIN_SECONDS: int = int(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+    # Keep access tokens in the database so restarts reuse them
+    TOKEN_CACHE_PERSIST: bool = os.getenv("TOKEN_CACHE_PERSIST", "true").lower() == "true"
+    
+    # Email sync
+    IMAP_FETCH_BATCH_SIZE: int = int(os.getenv("IMAP_FETCH_BATCH_SIZE", "200"))
+    # Synced emails written per database transaction
+    SYNC_DB_BATCH_SIZE: int = int(os.getenv("SYNC_DB_BATCH_SIZE", "500"))
+    # Batches buffered between sync pipeline stages
+    SYNC_PIPELINE_DEPTH: int = int(os.getenv("SYNC_PIPELINE_DEPTH", "2"))
+    # Processes used for MIME parsing; 0 parses on the event loop thread
+    PARSE_WORKERS: int = int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+    # Syncs a message may stop by failing to parse before it is skipped
+    SYNC_PARSE_MAX_ATTEMPTS: int = int(os.getenv("SYNC_PARSE_MAX_ATTEMPTS", "3"))
+    # "full" downloads whole messages, "headers" defers bodies and attachments until first read
+    IMAP_SYNC_MODE: str = os.getenv("IMAP_SYNC_MODE", "full")
+    # Threads available for blocking imaplib calls
+    IMAP_MAX_WORKERS: int = int(os.getenv("IMAP_MAX_WORKERS", "16"))
+    # Seconds an IMAP connect or read may wait on the server
+    IMAP_TIMEOUT_SECONDS: float = float(os.getenv("IMAP_TIMEOUT_SECONDS", "60"))
+    # Polling interval of accounts without a history yet
+    SYNC_INTERVAL_SECONDS: int = int(os.getenv("SYNC_INTERVAL_SECONDS", "300"))
+    # Bounds of the adaptive per-account polling interval
+    SYNC_MIN_INTERVAL_SECONDS: int = int(os.getenv("SYNC_MIN_INTERVAL_SECONDS", "60"))
+    SYNC_MAX_INTERVAL_SECONDS: int = int(os.getenv("SYNC_MAX_INTERVAL_SECONDS", "3600"))
+    # Longest interval for accounts of users with an open WebSocket
+    SYNC_ACTIVE_USER_INTERVAL_SECONDS: int = int(os.getenv("SYNC_ACTIVE_USER_INTERVAL_SECONDS", "120"))
+    # Averaging window of the per-account arrival rate
+    SYNC_RATE_WINDOW_SECONDS: int = int(os.getenv("SYNC_RATE_WINDOW_SECONDS", "21600"))
+    # Accounts synced at the same time, overall and per IMAP server
+    SYNC_CONCURRENCY: int = int(os.getenv("SYNC_CONCURRENCY", "10"))
+    SYNC_PROVIDER_CONCURRENCY: int = int(os.getenv("SYNC_PROVIDER_CONCURRENCY", "5"))
+    # Durable sync job queue consumed by python -m app.worker
+    JOB_LEASE_SECONDS: int = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+    JOB_MAX_ATTEMPTS: int = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+    JOB_RETRY_BASE_SECONDS: int = int(os.getenv("JOB_RETRY_BASE_SECONDS", "30"))
+    JOB_POLL_SECONDS: float = float(os.getenv("JOB_POLL_SECONDS", "2"))
+    # Workers that miss heartbeats for this long lose their accounts to the others
+    SYNC_NODE_TTL_SECONDS: int = int(os.getenv("SYNC_NODE_TTL_SECONDS", "30"))
+    # How often API processes check for notifications queued by sync workers
+    NOTIFICATION_POLL_SECONDS: float = float(os.getenv("NOTIFICATION_POLL_SECONDS", "1"))
+    # Port of the Prometheus metrics of python -m app.worker; 0 disables them
+    WORKER_METRICS_PORT: int = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+    # Run a sync worker inside the API process as well, e.g. for development;
+    # otherwise syncs only run in python -m app.worker
+    EMBEDDED_WORKER: bool = os.getenv("EMBEDDED_WORKER", "false").lower() == "true"
+    # Long-lived IMAP IDLE sessions for accounts of users with an open WebSocket
+    IMAP_IDLE_ENABLED: bool = os.getenv("IMAP_IDLE_ENABLED", "false").lower() == "true"
+    IMAP_IDLE_MAX_SESSIONS: int = int(os.getenv("IMAP_IDLE_MAX_SESSIONS", "100"))
+    # Servers may drop IDLE after 30 minutes, so it is renewed before that
+    IMAP_IDLE_TIMEOUT_SECONDS: int = int(os.getenv("IMAP_IDLE_TIMEOUT_SECONDS", "1500"))
+    
+    # Categorization
+    # Optional JSON file of category rules replacing the built-in term lists
+    CATEGORY_RULES_FILE: str = os.getenv("CATEGORY_RULES_FILE", "")
+    # Seconds a compiled set of user rules is reused before it is reloaded
+    USER_RULES_CACHE_TTL_SECONDS: int = int(os.getenv("USER_RULES_CACHE_TTL_SECONDS", "60"))
+    # Emails read and updated per transaction when re-categorizing stored mail
+    RECATEGORIZE_CHUNK_SIZE: int = int(os.getenv("RECATEGORIZE_CHUNK_SIZE", "1000"))
+    # Trained classifier (needs numpy); predictions below the confidence keep the keyword category
+    CLASSIFIER_ENABLED: bool = os.getenv("CLASSIFIER_ENABLED", "false").lower() == "true"
+    CLASSIFIER_MODEL_DIR: str = os.getenv("CLASSIFIER_MODEL_DIR", "")
+    # How often sync workers and API processes look for a newly trained classifier
+    CLASSIFIER_RELOAD_SECONDS: int = int(os.getenv("CLASSIFIER_RELOAD_SECONDS", "60"))
+    CLASSIFIER_MIN_CONFIDENCE: float = float(os.getenv("CLASSIFIER_MIN_CONFIDENCE", "0.9"))
+    CLASSIFIER_HASH_BITS: int = int(os.getenv("CLASSIFIER_HASH_BITS", "18"))
+    # Training weight of categories set by the user relative to assigned ones
+    CLASSIFIER_MANUAL_WEIGHT: float = float(os.getenv("CLASSIFIER_MANUAL_WEIGHT", "5"))
 
 settings = Settings() 
\ No newline at end of file
@@ -6,6 +6,19 @@ from pathlib import Path
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def add_missing_columns(conn, cursor, table: str, columns: dict):
+    """Add columns that are missing from an existing table"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {column[1] for column in cursor.fetchall()}
+    
+    for name, definition in columns.items():
+        if name in existing:
+            continue
+        logger.info(f"Adding {name} column to {table} table...")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+        conn.commit()
+        logger.info(f"Added {name} column to {table} table")
+
 def migrate():
     """Run migrations"""
     logger.info("Running database migrations...")
@@ -41,6 +54,92 @@ def migrate():
         else:
             logger.info("Category column already exists in emails table")
         
+        # Columns for header-only sync; existing rows were synced with full bodies
+        add_missing_columns(conn, cursor, "emails", {
+            "folder": "TEXT DEFAULT 'INBOX'",
+            "uid": "BIGINT",
+            "size": "INTEGER",
+            "body_loaded": "BOOLEAN DEFAULT 1",
+            "has_attachments": "BOOLEAN DEFAULT 0",
+        })
+        
+        # Adaptive sync scheduling
+        add_missing_columns(conn, cursor, "email_accounts", {
+            "arrival_rate": "FLOAT DEFAULT 0",
+            "last_change_at": "DATETIME",
+            "sync_interval": "INTEGER",
+            "next_sync_at": "DATETIME",
+        })
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_email_accounts_next_sync_at ON email_accounts(next_sync_at)")
+        conn.commit()
+        
+        # Categories chosen by the user
+        add_missing_columns(conn, cursor, "emails", {
+            "category_manual": "BOOLEAN DEFAULT 0",
+        })
+        
+        # Cached OAuth access tokens
+        add_missing_columns(conn, cursor, "email_accounts", {
+            "access_token": "TEXT",
+            "access_token_expires_at": "DATETIME",
+        })
+        
+        # Composite unique index used for deduplication
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'uq_emails_account_message_id'")
+        if not cursor.fetchone():
+            logger.info("Removing duplicate emails before creating unique index...")
+            cursor.execute("""
+                DELETE FROM emails
+                WHERE message_id != ''
+                AND rowid NOT IN (
+                    SELECT MIN(rowid) FROM emails
+                    WHERE message_id != ''
+                    GROUP BY email_account_id, message_id
+                )
+            """)
+            logger.info(f"Removed {cursor.rowcount} duplicate emails")
+            cursor.execute("DELETE FROM attachments WHERE email_id NOT IN (SELECT id FROM emails)")
+            cursor.execute("""
+                CREATE UNIQUE INDEX uq_emails_account_message_id
+                ON emails(email_account_id, message_id)
+                WHERE message_id != ''
+            """)
+            conn.commit()
+            logger.info("Created unique index on emails(email_account_id, message_id)")
+        
+        # Content-addressed attachment storage
+        add_missing_columns(conn, cursor, "attachments", {
+            "content_hash": "TEXT",
+        })
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_attachments_content_hash ON attachments(content_hash)")
+        conn.commit()
+        
+        # Progress of interrupted folder syncs
+        add_missing_columns(conn, cursor, "mailbox_sync_states", {
+            "resume_low_uid": "BIGINT",
+            "resume_high_uid": "BIGINT",
+        })
+        
+        # Folder counters used to skip unchanged folders
+        add_missing_columns(conn, cursor, "mailbox_sync_states", {
+            "uid_next": "BIGINT",
+            "message_count": "INTEGER",
+            "highest_modseq": "BIGINT",
+        })
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_emails_account_folder_uid ON emails(email_account_id, folder, uid)")
+        conn.commit()
+        
+        # Messages that repeatedly failed to parse
+        add_missing_columns(conn, cursor, "mailbox_sync_states", {
+            "parse_failed_uid": "BIGINT",
+            "parse_failures": "INTEGER DEFAULT 0",
+        })
+        
+        # Arguments of re-categorization jobs
+        add_missing_columns(conn, cursor, "jobs", {
+            "payload": "TEXT",
+        })
+        
         conn.close()
         logger.info("Database migrations completed successfully")
         
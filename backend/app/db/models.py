@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, String, Integer, ForeignKey, Text, DateTime, Table
+from sqlalchemy import Boolean, Column, String, Integer, BigInteger, Float, ForeignKey, Text, DateTime, Table, UniqueConstraint, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
@@ -23,6 +23,7 @@ class User(Base):
 
     # Relationships
     email_accounts = relationship("EmailAccount", back_populates="user", cascade="all, delete-orphan")
+    category_rules = relationship("CategoryRule", back_populates="user", cascade="all, delete-orphan")
 
 class EmailAccount(Base):
     __tablename__ = "email_accounts"
@@ -32,28 +33,81 @@ class EmailAccount(Base):
     email_address = Column(String, index=True)
     refresh_token = Column(String)
     client_id = Column(String)
+    access_token = Column(String)  # Cached OAuth access token
+    access_token_expires_at = Column(DateTime(timezone=True))
     last_sync = Column(DateTime(timezone=True))
+    # Adaptive polling: messages per hour, time new mail was last found and the resulting schedule
+    arrival_rate = Column(Float, default=0.0)
+    last_change_at = Column(DateTime(timezone=True))
+    sync_interval = Column(Integer)  # Seconds between polls chosen after the last sync
+    next_sync_at = Column(DateTime(timezone=True), index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     # Relationships
     user = relationship("User", back_populates="email_accounts")
     emails = relationship("Email", back_populates="email_account", cascade="all, delete-orphan")
+    sync_states = relationship("MailboxSyncState", back_populates="email_account", cascade="all, delete-orphan")
+
+class MailboxSyncState(Base):
+    __tablename__ = "mailbox_sync_states"
+    __table_args__ = (
+        UniqueConstraint("email_account_id", "folder", name="uq_mailbox_sync_states_account_folder"),
+    )
+
+    id = Column(String, primary_key=True, index=True, default=generate_uuid)
+    email_account_id = Column(String, ForeignKey("email_accounts.id", ondelete="CASCADE"), index=True)
+    folder = Column(String, default="INBOX")
+    uid_validity = Column(BigInteger)  # UIDVALIDITY of the folder when last synced
+    last_uid = Column(BigInteger, default=0)  # Highest UID already synced
+    # UIDs from resume_low_uid to resume_high_uid were stored by a sync that did not finish
+    resume_low_uid = Column(BigInteger)
+    resume_high_uid = Column(BigInteger)
+    # STATUS counters when last synced; a folder reporting the same ones is skipped
+    uid_next = Column(BigInteger)
+    message_count = Column(Integer)
+    highest_modseq = Column(BigInteger)  # Flags changed after this are synced next time
+    # Message that stopped the last syncs because it could not be parsed, and how many
+    parse_failed_uid = Column(BigInteger)
+    parse_failures = Column(Integer, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    # Relationships
+    email_account = relationship("EmailAccount", back_populates="sync_states")
 
 class Email(Base):
     __tablename__ = "emails"
+    __table_args__ = (
+        # One row per message and account; messages without a Message-ID are not deduplicated
+        Index(
+            "uq_emails_account_message_id",
+            "email_account_id",
+            "message_id",
+            unique=True,
+            sqlite_where=text("message_id != ''"),
+            postgresql_where=text("message_id != ''")
+        ),
+        # Flag changes and expunges from the server are matched by UID
+        Index("ix_emails_account_folder_uid", "email_account_id", "folder", "uid"),
+    )
 
     id = Column(String, primary_key=True, index=True, default=generate_uuid)
     email_account_id = Column(String, ForeignKey("email_accounts.id", ondelete="CASCADE"))
     message_id = Column(String, index=True)  # Email message ID for deduplication
+    folder = Column(String, default="INBOX")  # IMAP folder the message was synced from
+    uid = Column(BigInteger)  # IMAP UID within folder, used to download the body on demand
+    size = Column(Integer)  # RFC822.SIZE reported by the server
     subject = Column(String)
     sender = Column(String)
     recipients = Column(String)
     date_received = Column(DateTime(timezone=True))
     body_text = Column(Text)
     body_html = Column(Text)
+    body_loaded = Column(Boolean, default=True)  # False until the body of a header-only sync is downloaded
+    has_attachments = Column(Boolean, default=False)
     is_read = Column(Boolean, default=False)
     category = Column(String, default="inbox", index=True)  # Email category/label
+    category_manual = Column(Boolean, default=False)  # Set by the user, kept by re-categorization
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Relationships
@@ -68,8 +122,75 @@ class Attachment(Base):
     filename = Column(String)
     content_type = Column(String)
     file_path = Column(String)  # Path to stored attachment
+    content_hash = Column(String, index=True)  # SHA-256 of the content; rows sharing it share the file
     size = Column(Integer)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Relationships
-    email = relationship("Email", back_populates="attachments") 
\ No newline at end of file
+    email = relationship("Email", back_populates="attachments") 
+
+class CategoryRule(Base):
+    __tablename__ = "category_rules"
+
+    id = Column(String, primary_key=True, index=True, default=generate_uuid)
+    user_id = Column(String, ForeignKey("users.id", ondelete="CASCADE"), index=True)
+    rule_type = Column(String)  # sender, domain, subject or header
+    value = Column(String)  # Address, domain or keyword to match
+    header_name = Column(String)  # Header checked by header rules
+    category = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Relationships
+    user = relationship("User", back_populates="category_rules")
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # At most one queued job of a kind per account; later requests join it
+        Index(
+            "uq_jobs_queued_kind_account",
+            "kind",
+            "account_id",
+            unique=True,
+            sqlite_where=text("status = 'queued'"),
+            postgresql_where=text("status = 'queued'")
+        ),
+        Index("ix_jobs_status_run_at", "status", "priority", "run_at"),
+    )
+
+    id = Column(String, primary_key=True, index=True, default=generate_uuid)
+    kind = Column(String)  # e.g. sync_account
+    account_id = Column(String, ForeignKey("email_accounts.id", ondelete="CASCADE"))
+    user_id = Column(String)
+    payload = Column(Text)  # JSON arguments of kinds that need more than the account
+    priority = Column(Integer, default=1)  # Lower runs first
+    status = Column(String, default="queued")  # queued, running, done or failed
+    attempts = Column(Integer, default=0)
+    run_at = Column(DateTime(timezone=True))  # Not claimed before this time
+    locked_by = Column(String)  # Worker holding the lease
+    lease_expires_at = Column(DateTime(timezone=True))  # Running jobs are reclaimed after this
+    last_error = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True))
+
+class SyncNode(Base):
+    __tablename__ = "sync_nodes"
+
+    id = Column(String, primary_key=True)  # Worker ID, host:pid
+    started_at = Column(DateTime(timezone=True), server_default=func.now())
+    heartbeat_at = Column(DateTime(timezone=True), index=True)  # Lease on the worker's share of the accounts
+
+class Notification(Base):
+    __tablename__ = "notifications"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)  # API processes relay rows in this order
+    user_id = Column(String)
+    payload = Column(Text)  # JSON message for the user's WebSockets
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+class UserPresence(Base):
+    __tablename__ = "user_presence"
+
+    user_id = Column(String, primary_key=True)
+    node_id = Column(String, primary_key=True)  # API process holding the WebSocket, host:pid
+    seen_at = Column(DateTime(timezone=True), index=True)  # Renewed while that process runs
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""
+Content-addressed attachment storage
+
+Attachments are stored once per distinct content under
+attachments/<sha[0:2]>/<sha[2:4]>/<sha>, however many emails carry them. Rows
+in the attachments table that share a content_hash act as the reference count
+of the file. Like parser.py this module only uses the standard library, so the
+parsing worker processes can write attachments directly.
+"""
+import binascii
+import hashlib
+import os
+import tempfile
+import time
+from email.message import Message
+from typing import Iterable, Iterator, Tuple
+
+ATTACHMENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "attachments")
+
+# Encoded characters decoded per step, so large attachments are never decoded in one piece
+CHUNK_SIZE = 64 * 1024
+
+def content_path(digest: str, root: str = ATTACHMENTS_DIR) -> str:
+    """Sharded path of the file holding the content with this SHA-256"""
+    return os.path.join(root, digest[:2], digest[2:4], digest)
+
+def iter_decoded_payload(part: Message) -> Iterator[bytes]:
+    """Yield the decoded payload of a MIME part in chunks"""
+    if part.is_multipart():
+        # e.g. a forwarded message/rfc822 attachment: store it as-is
+        yield part.as_bytes()
+        return
+    
+    payload = part.get_payload()
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+    
+    if encoding == 'base64':
+        pending = ''
+        for start in range(0, len(payload), CHUNK_SIZE):
+            pending += ''.join(payload[start:start + CHUNK_SIZE].split())
+            usable = len(pending) - len(pending) % 4
+            if usable:
+                yield binascii.a2b_base64(pending[:usable])
+                pending = pending[usable:]
+        if pending:
+            # Tolerate missing padding like the email package does
+            yield binascii.a2b_base64(pending + '=' * (-len(pending) % 4))
+    elif encoding == 'quoted-printable':
+        # Soft line breaks never span lines, so whole lines can be decoded independently
+        lines = []
+        size = 0
+        for line in payload.splitlines(keepends=True):
+            lines.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield binascii.a2b_qp(''.join(lines).encode('ascii', 'surrogateescape'))
+                lines, size = [], 0
+        if lines:
+            yield binascii.a2b_qp(''.join(lines).encode('ascii', 'surrogateescape'))
+    else:
+        yield part.get_payload(decode=True) or b''
+
+def store_part(part: Message, root: str = ATTACHMENTS_DIR) -> Tuple[str, str, int]:
+    """
+    Decode a MIME part into the store, returning (sha256, path, size)
+    
+    The content is streamed into a temporary file while being hashed, then moved
+    into place. If the content is already stored the new copy is discarded.
+    """
+    os.makedirs(root, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=root, prefix='.incoming-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            hasher = hashlib.sha256()
+            size = 0
+            try:
+                for chunk in iter_decoded_payload(part):
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            except (binascii.Error, ValueError):
+                # Malformed encoding: fall back to the email package's lenient decoder
+                f.seek(0)
+                f.truncate()
+                data = part.get_payload(decode=True) or b''
+                hasher = hashlib.sha256(data)
+                f.write(data)
+                size = len(data)
+        
+        digest = hasher.hexdigest()
+        path = content_path(digest, root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            # A fresh mtime protects the file from a concurrent release of its last reference
+            os.utime(path)
+        else:
+            os.replace(tmp_path, path)
+        return digest, path, size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def remove_files(paths: Iterable[str], min_age: float = 0):
+    """Delete files, skipping any modified within the last min_age seconds"""
+    now = time.time()
+    for path in paths:
+        try:
+            if min_age and now - os.path.getmtime(path) < min_age:
+                continue
+            os.remove(path)
+        except OSError:
+            pass
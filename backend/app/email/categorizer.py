@@ -0,0 +1,135 @@
+"""
+Keyword categorization for emails
+
+Term dictionaries are compiled once into one regex per field. Each regex is a
+zero-width lookahead over the alternation of every term for that field, so a
+single scan finds every term occurrence, overlapping ones included, and reports
+all matching categories at once.
+"""
+import json
+import logging
+import re
+from typing import Any, Dict, Hashable, Iterable, List, Mapping, NamedTuple, Optional, Sequence, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATEGORY = "inbox"
+
+# Fields a rule can match against, as named in email records
+FIELDS = ("subject", "sender", "body_text")
+
+class CategoryRule(NamedTuple):
+    category: str
+    terms: Tuple[str, ...]
+    fields: Tuple[str, ...] = ("subject",)
+
+# Rules in priority order; the first category that matches wins
+DEFAULT_RULES = (
+    # Social media related emails
+    CategoryRule(
+        "social",
+        ('facebook', 'twitter', 'instagram', 'linkedin', 'weibo', 'wechat', 'qq', 'tiktok'),
+        ("sender", "subject")
+    ),
+    # Promotions/marketing
+    CategoryRule("promotions", ('promotion', 'discount', 'sale', 'off', 'deal', 'offer', '促销', '优惠', '折扣')),
+    # Updates/notifications
+    CategoryRule("updates", ('update', 'notification', 'confirm', 'verify', 'security', '更新', '通知')),
+    # Potential spam
+    CategoryRule("spam", ('urgent', 'winner', 'won', 'prize', 'lottery', 'million', 'bitcoin', 'invest')),
+    # Important emails
+    CategoryRule("important", ('important', 'urgent', 'attention', 'required', 'action', '重要', '紧急')),
+)
+
+class FieldMatcher:
+    """All terms for one field compiled into a single pattern"""
+    
+    def __init__(self, term_labels: Dict[str, Set[Hashable]]):
+        terms = sorted(term_labels, key=len, reverse=True)
+        
+        # The lookahead reports only the longest term at each position, so a term
+        # also carries the labels of every shorter term it contains
+        self.labels: Dict[str, frozenset] = {}
+        for term in terms:
+            labels = set()
+            for other in terms:
+                if other in term:
+                    labels |= term_labels[other]
+            self.labels[term] = frozenset(labels)
+        
+        alternation = "|".join(re.escape(term) for term in terms)
+        self.pattern = re.compile(f"(?=({alternation}))")
+    
+    def match(self, text: Optional[str], found: Set[Hashable]):
+        """Add the labels (categories or rule positions) of every term found in text"""
+        if not text:
+            return
+        for match in self.pattern.finditer(text.lower()):
+            found |= self.labels[match.group(1)]
+
+class Categorizer:
+    """Compiled set of category rules"""
+    
+    def __init__(self, rules: Sequence[CategoryRule], default: str = DEFAULT_CATEGORY):
+        self.default = default
+        self.priority = [rule.category for rule in rules]
+        
+        term_categories: Dict[str, Dict[str, Set[str]]] = {}
+        for rule in rules:
+            for field in rule.fields:
+                if field not in FIELDS:
+                    raise ValueError(f"Unknown field {field} in {rule.category} rule")
+                for term in rule.terms:
+                    term = term.lower()
+                    if term:
+                        term_categories.setdefault(field, {}).setdefault(term, set()).add(rule.category)
+        
+        self.matchers = {field: FieldMatcher(terms) for field, terms in term_categories.items()}
+    
+    def match(self, subject: Optional[str], sender: Optional[str], body: Optional[str] = None) -> Set[str]:
+        """Return every category with a term in the fields it applies to"""
+        values = {"subject": subject, "sender": sender, "body_text": body}
+        found: Set[str] = set()
+        for field, matcher in self.matchers.items():
+            matcher.match(values[field], found)
+        return found
+    
+    def choose(self, found: Set[str]) -> str:
+        """Pick the highest priority category out of the matches"""
+        for category in self.priority:
+            if category in found:
+                return category
+        return self.default
+    
+    def categorize(self, subject: Optional[str], sender: Optional[str], body: Optional[str] = None) -> str:
+        return self.choose(self.match(subject, sender, body))
+    
+    def categorize_many(self, records: Iterable[Mapping[str, Any]]) -> List[str]:
+        """Categorize email records (dicts with subject, sender and body_text)"""
+        return [
+            self.categorize(record.get("subject"), record.get("sender"), record.get("body_text"))
+            for record in records
+        ]
+
+def load_rules(path: str) -> List[CategoryRule]:
+    """
+    Load rules from a JSON file
+    
+    The file holds a list of {"category", "terms", "fields"} objects in priority
+    order; "fields" defaults to ["subject"].
+    """
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    return [
+        CategoryRule(entry["category"], tuple(entry["terms"]), tuple(entry.get("fields", ("subject",))))
+        for entry in entries
+    ]
+
+def build_categorizer(rules_file: Optional[str] = None) -> Categorizer:
+    """Build the categorizer from rules_file, or from DEFAULT_RULES if it is not set"""
+    if rules_file:
+        try:
+            return Categorizer(load_rules(rules_file))
+        except Exception as e:
+            logger.error(f"Error loading category rules from {rules_file}: {str(e)}")
+    return Categorizer(DEFAULT_RULES)
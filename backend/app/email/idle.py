@@ -0,0 +1,239 @@
+import asyncio
+import imaplib
+import logging
+import re
+import select
+import socket
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from sqlalchemy import select as sql_select
+
+from app.core.config import settings
+from app.db.models import EmailAccount
+from app.db.session import AsyncSessionLocal
+from app.email.jobs import enqueue_sync
+from app.email.scheduler import PRIORITY_HIGH
+
+logger = logging.getLogger(__name__)
+
+# Untagged responses that mean the selected mailbox changed; with QRESYNC
+# enabled expunges are reported as VANISHED instead of EXPUNGE
+_IDLE_CHANGE_RE = re.compile(rb'^\* (\d+ (EXISTS|EXPUNGE|FETCH)|VANISHED)\b', re.IGNORECASE)
+
+# Every idling session blocks a thread, so IDLE gets its own pool sized to the session cap
+_idle_executor = ThreadPoolExecutor(
+    max_workers=max(1, settings.IMAP_IDLE_MAX_SESSIONS),
+    thread_name_prefix="imap-idle"
+)
+
+def has_buffered_input(mail: imaplib.IMAP4) -> bool:
+    """
+    Check whether imaplib already holds response bytes that select() cannot see
+    
+    Both the TLS layer and imaplib's buffered reader can read ahead of the line
+    they return, e.g. an EXISTS that arrived in the same segment as the IDLE
+    continuation.
+    """
+    sock = mail.socket()
+    if isinstance(sock, ssl.SSLSocket) and sock.pending():
+        return True
+    
+    # peek() returns buffered bytes as they are but reads the socket when there are
+    # none, so that read must not block
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+def idle_wait(mail: imaplib.IMAP4, wake_sock: socket.socket, timeout: float) -> bool:
+    """
+    Run IMAP IDLE until the mailbox changes, timeout expires or wake_sock is written to
+    
+    Returns True if the server reported a change.
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    line = mail.readline()
+    if not line.startswith(b'+'):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+    
+    sock = mail.socket()
+    changed = False
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not has_buffered_input(mail):
+            readable, _, _ = select.select([sock, wake_sock], [], [], remaining)
+            if wake_sock in readable:
+                wake_sock.recv(64)
+                break
+            if sock not in readable:
+                break
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        if _IDLE_CHANGE_RE.match(line):
+            changed = True
+            break
+    
+    # Leave IDLE and consume everything up to the tagged completion
+    mail.send(b'DONE\r\n')
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+        if _IDLE_CHANGE_RE.match(line):
+            changed = True
+        if line.startswith(tag):
+            break
+    return changed
+
+class IdleWatcher:
+    """
+    Long-lived authenticated session for one account that queues a sync
+    whenever IDLE reports a change
+    
+    The sync itself runs in a sync worker like any other, so the IDLE session
+    only ever waits on the selected INBOX.
+    """
+    
+    def __init__(self, account_id: str, user_id: str):
+        self.account_id = account_id
+        self.user_id = user_id
+        self.last_used = time.monotonic()
+        self.stopped = False
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    async def request_sync(self):
+        async with AsyncSessionLocal() as db:
+            await enqueue_sync(db, self.account_id, self.user_id, PRIORITY_HIGH)
+    
+    async def run(self):
+        # 在函数内部导入而不是在模块顶部
+        from app.email.service import open_account_client
+        
+        loop = asyncio.get_running_loop()
+        backoff = 5
+        while not self.stopped:
+            client = None
+            try:
+                client = await open_account_client(self.account_id)
+                if client is None:
+                    return
+                await client.select("INBOX", readonly=True)
+                
+                # Catch up on anything that arrived while no session was open
+                await self.request_sync()
+                backoff = 5
+                
+                while not self.stopped:
+                    changed = await loop.run_in_executor(
+                        _idle_executor,
+                        idle_wait,
+                        client.mail,
+                        self.wake_r,
+                        settings.IMAP_IDLE_TIMEOUT_SECONDS
+                    )
+                    if changed and not self.stopped:
+                        logger.info(f"IDLE reported changes for {client.email_addr}")
+                        self.last_used = time.monotonic()
+                        await self.request_sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"IDLE session error for account {self.account_id}: {str(e)}")
+            finally:
+                if client:
+                    await client.logout()
+            
+            if not self.stopped:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 300)
+    
+    async def stop(self):
+        self.stopped = True
+        try:
+            # Wakes the IDLE thread so the session is released right away
+            self.wake_w.send(b'x')
+        except OSError:
+            pass
+        if self.task:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.task), timeout=30)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                self.task.cancel()
+            except Exception:
+                pass
+        self.wake_r.close()
+        self.wake_w.close()
+
+class IdleManager:
+    """
+    Keeps at most max_sessions IDLE sessions open
+    
+    When the cap is reached the least recently used session is closed to make
+    room. Every account is still polled on its interval; a session only makes
+    syncs start as soon as mail arrives.
+    """
+    
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max(1, max_sessions)
+        self.watchers: Dict[str, IdleWatcher] = {}
+    
+    async def watch(self, account_id: str, user_id: str):
+        """Open an IDLE session for an account, or mark an existing one as recently used"""
+        watcher = self.watchers.get(account_id)
+        if watcher and watcher.task and not watcher.task.done():
+            watcher.last_used = time.monotonic()
+            return
+        
+        if watcher:
+            await self.unwatch(account_id)
+        
+        while len(self.watchers) >= self.max_sessions:
+            lru_id = min(self.watchers, key=lambda key: self.watchers[key].last_used)
+            logger.info(f"Closing IDLE session for account {lru_id} to stay under the session cap")
+            await self.unwatch(lru_id)
+        
+        watcher = IdleWatcher(account_id, user_id)
+        self.watchers[account_id] = watcher
+        watcher.start()
+    
+    async def watch_user(self, user_id: str):
+        """Open IDLE sessions for every account of a user"""
+        async with AsyncSessionLocal() as db:
+            query = sql_select(EmailAccount.id).where(EmailAccount.user_id == user_id)
+            result = await db.execute(query)
+            account_ids = [row[0] for row in result]
+        
+        for account_id in account_ids:
+            await self.watch(account_id, user_id)
+    
+    async def unwatch_user(self, user_id: str):
+        """Close the IDLE sessions of a user's accounts"""
+        account_ids = [account_id for account_id, watcher in self.watchers.items() if watcher.user_id == user_id]
+        await asyncio.gather(*(self.unwatch(account_id) for account_id in account_ids))
+    
+    async def unwatch(self, account_id: str):
+        watcher = self.watchers.pop(account_id, None)
+        if watcher:
+            await watcher.stop()
+    
+    async def stop(self):
+        """Close every session; their threads would otherwise keep the process alive until IDLE times out"""
+        await asyncio.gather(*(self.unwatch(account_id) for account_id in list(self.watchers)))
+
+idle_manager = IdleManager(settings.IMAP_IDLE_MAX_SESSIONS)
@@ -0,0 +1,352 @@
+import asyncio
+import functools
+import imaplib
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+IMAP_HOST = 'outlook.office365.com'
+
+# imaplib is blocking, so every IMAP call runs on this bounded pool instead of the event loop
+_imap_executor = ThreadPoolExecutor(
+    max_workers=settings.IMAP_MAX_WORKERS,
+    thread_name_prefix="imap"
+)
+
+# Start of a per-message FETCH response, e.g. b'12 (UID 3456 RFC822 {2048}'
+_FETCH_START_RE = re.compile(rb'^(\d+) \(')
+_FETCH_UID_RE = re.compile(rb'[( ]UID (\d+)')
+_FETCH_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+_STATUS_ITEM_RE = re.compile(rb'(UIDNEXT|UIDVALIDITY|MESSAGES|HIGHESTMODSEQ) (\d+)')
+_FETCH_FLAGS_RE = re.compile(rb'FLAGS \(([^)]*)\)')
+
+class FetchedMessage(NamedTuple):
+    uid: int
+    meta: bytes  # Non-literal part of the FETCH response (UID, FLAGS, sizes, ...)
+    literals: List[bytes]  # Literal payloads in the order the server sent them
+
+class MailboxStatus(NamedTuple):
+    uid_next: Optional[int]
+    uid_validity: Optional[int]
+    messages: Optional[int]
+    highest_modseq: Optional[int]  # Only from servers with CONDSTORE
+
+def get_uid_validity(mail: imaplib.IMAP4) -> Optional[int]:
+    """Read the UIDVALIDITY reported by the last SELECT"""
+    typ, data = mail.response('UIDVALIDITY')
+    if not data or data[0] is None:
+        return None
+    try:
+        return int(data[0])
+    except (TypeError, ValueError):
+        return None
+
+def get_uid_next(mail: imaplib.IMAP4) -> Optional[int]:
+    """Read the UIDNEXT reported by the last SELECT"""
+    typ, data = mail.response('UIDNEXT')
+    if not data or data[0] is None:
+        return None
+    try:
+        return int(data[0])
+    except (TypeError, ValueError):
+        return None
+
+def get_highest_modseq(mail: imaplib.IMAP4) -> Optional[int]:
+    """Read the HIGHESTMODSEQ reported by the last SELECT of a CONDSTORE server"""
+    typ, data = mail.response('HIGHESTMODSEQ')
+    if not data or data[0] is None:
+        return None
+    try:
+        return int(data[0])
+    except (TypeError, ValueError):
+        return None
+
+def search_new_uids(mail: imaplib.IMAP4, last_uid: int) -> Optional[List[int]]:
+    """Search for UIDs greater than last_uid in the selected folder"""
+    if last_uid:
+        status, data = mail.uid('search', None, f'UID {last_uid + 1}:*')
+    else:
+        status, data = mail.uid('search', None, 'ALL')
+    if status != 'OK':
+        return None
+    # "n:*" always matches the highest UID, even when it is below n
+    return sorted(uid for uid in (int(u) for u in data[0].split()) if uid > last_uid)
+
+def mailbox_status(mail: imaplib.IMAP4, folder: str) -> Optional[MailboxStatus]:
+    """Read a folder's counters with STATUS, without selecting it"""
+    items = "UIDNEXT UIDVALIDITY MESSAGES"
+    if "CONDSTORE" in mail.capabilities:
+        items += " HIGHESTMODSEQ"
+    status, data = mail.status(folder, f"({items})")
+    if status != 'OK' or not data or not data[0]:
+        return None
+    values = {name.decode(): int(value) for name, value in _STATUS_ITEM_RE.findall(data[0])}
+    return MailboxStatus(
+        values.get("UIDNEXT"),
+        values.get("UIDVALIDITY"),
+        values.get("MESSAGES"),
+        values.get("HIGHESTMODSEQ")
+    )
+
+def format_uid_set(uids: Iterable[int]) -> str:
+    """Compress UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7] -> '1:3,7'"""
+    ranges = []
+    start = prev = None
+    for uid in sorted(set(uids)):
+        if prev is not None and uid == prev + 1:
+            prev = uid
+            continue
+        if start is not None:
+            ranges.append(f"{start}:{prev}" if start != prev else str(start))
+        start = prev = uid
+    if start is not None:
+        ranges.append(f"{start}:{prev}" if start != prev else str(start))
+    return ",".join(ranges)
+
+def parse_uid_set(uid_set: str) -> List[int]:
+    """Expand an IMAP sequence set, e.g. '1:3,7' -> [1, 2, 3, 7]"""
+    uids = []
+    for part in uid_set.split(","):
+        if not part:
+            continue
+        start, _, end = part.partition(":")
+        low, high = sorted((int(start), int(end or start)))
+        uids.extend(range(low, high + 1))
+    return uids
+
+def chunked(items: List[int], size: int) -> Iterator[List[int]]:
+    """Split a list into consecutive chunks of at most size items"""
+    size = max(1, size)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def parse_fetch_response(data: list) -> List[FetchedMessage]:
+    """Split a multi-message FETCH response into one entry per message"""
+    messages = []
+    current = None
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            meta, literal = item
+        else:
+            meta, literal = item, None
+        
+        if _FETCH_START_RE.match(meta):
+            current = (bytearray(meta), [])
+            messages.append(current)
+        elif current is None:
+            continue
+        else:
+            # Continuation of the current message (closing paren, trailing UID, next literal)
+            current[0].extend(meta)
+        
+        if literal is not None:
+            current[1].append(literal)
+    
+    fetched = []
+    for meta, literals in messages:
+        # Unsolicited FETCH responses (e.g. flag updates) carry no UID and are dropped
+        match = _FETCH_UID_RE.search(meta)
+        if not match:
+            continue
+        fetched.append(FetchedMessage(int(match.group(1)), bytes(meta), literals))
+    return fetched
+
+def fetch_uid_batch(mail: imaplib.IMAP4, uids: List[int], items: str = '(UID RFC822)') -> Optional[List[FetchedMessage]]:
+    """Fetch a set of UIDs in a single round-trip"""
+    if not uids:
+        return []
+    status, data = mail.uid('fetch', format_uid_set(uids), items)
+    if status != 'OK':
+        return None
+    return parse_fetch_response(data)
+
+def fetch_flags(
+    mail: imaplib.IMAP4,
+    max_uid: int,
+    changed_since: Optional[int] = None,
+    vanished: bool = False
+) -> Optional[Tuple[List[FetchedMessage], List[int]]]:
+    """
+    Fetch the FLAGS of messages up to max_uid
+    
+    With changed_since (CONDSTORE), only messages whose flags changed after that
+    mod-sequence are returned. With vanished as well (QRESYNC enabled), the UIDs
+    expunged since then are returned too; otherwise that list is empty.
+    """
+    items = '(UID FLAGS)'
+    if changed_since is not None:
+        items += f' (CHANGEDSINCE {changed_since} VANISHED)' if vanished else f' (CHANGEDSINCE {changed_since})'
+    status, data = mail.uid('fetch', f'1:{max_uid}', items)
+    if status != 'OK':
+        return None
+    
+    # VANISHED (EARLIER) responses are kept apart from the FETCH data by imaplib
+    expunged = []
+    typ, responses = mail.response('VANISHED')
+    for response in responses or []:
+        if response:
+            expunged.extend(parse_uid_set(response.decode().replace("(EARLIER)", "").strip()))
+    return parse_fetch_response(data), expunged
+
+def search_uid_by_message_id(mail: imaplib.IMAP4, message_id: str) -> Optional[int]:
+    """Look up the UID of a message in the selected folder by its Message-ID header"""
+    if not message_id:
+        return None
+    quoted = '"' + message_id.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    status, data = mail.uid('search', None, 'HEADER', 'Message-ID', quoted)
+    if status != 'OK' or not data or not data[0]:
+        return None
+    uids = data[0].split()
+    return int(uids[-1]) if uids else None
+
+def parse_fetch_size(meta: bytes) -> Optional[int]:
+    """Extract RFC822.SIZE from the metadata of a FETCH response"""
+    match = _FETCH_SIZE_RE.search(meta)
+    return int(match.group(1)) if match else None
+
+def parse_fetch_flags(meta: bytes) -> Optional[List[str]]:
+    """Extract the FLAGS list from the metadata of a FETCH response"""
+    match = _FETCH_FLAGS_RE.search(meta)
+    return match.group(1).decode().split() if match else None
+
+def is_seen(meta: bytes) -> bool:
+    """Whether a FETCH response carries the \\Seen flag"""
+    return "\\Seen" in (parse_fetch_flags(meta) or [])
+
+def bodystructure_has_attachments(meta: bytes) -> bool:
+    """Check a BODYSTRUCTURE for parts with an attachment disposition"""
+    return b'"ATTACHMENT"' in meta.upper()
+
+def generate_auth_string(user: str, token: str) -> str:
+    """Generate OAuth2 authentication string"""
+    auth_string = f"user={user}\1auth=Bearer {token}\1\1"
+    return auth_string
+
+def open_imap_connection(email_addr: str, access_token: str) -> imaplib.IMAP4_SSL:
+    """Open an IMAP connection and authenticate with OAuth2"""
+    logger.info(f"Connecting to IMAP server for {email_addr}")
+    
+    # Connect to server. The timeout stays on the socket for the whole session, so
+    # a stalled server fails the call instead of holding an IMAP thread for good
+    mail = imaplib.IMAP4_SSL(IMAP_HOST, timeout=settings.IMAP_TIMEOUT_SECONDS)
+    
+    # Authenticate
+    auth_string = generate_auth_string(email_addr, access_token)
+    logger.info(f"Authenticating {email_addr} with OAuth2")
+    
+    try:
+        auth_result = mail.authenticate('XOAUTH2', lambda x: auth_string)
+        logger.info(f"Authentication result: {auth_result}")
+    except Exception as auth_err:
+        logger.error(f"Authentication error for {email_addr}: {str(auth_err)}")
+        try:
+            mail.shutdown()
+        except Exception:
+            pass
+        raise
+    
+    # Servers may extend their capabilities once authenticated
+    typ, data = mail.response('CAPABILITY')
+    if data and data[-1]:
+        mail.capabilities = tuple(data[-1].decode().upper().split())
+    
+    # With QRESYNC, flag fetches also report expunged messages
+    if "QRESYNC" in mail.capabilities and "ENABLE" in mail.capabilities:
+        try:
+            mail.enable("QRESYNC")
+        except imaplib.IMAP4.error as e:
+            logger.warning(f"ENABLE QRESYNC failed for {email_addr}: {str(e)}")
+            mail.capabilities = tuple(capability for capability in mail.capabilities if capability != "QRESYNC")
+    
+    return mail
+
+def select_folder(mail: imaplib.IMAP4, folder: str, readonly: bool = False) -> Tuple[str, MailboxStatus]:
+    """Select a folder and return the status together with the counters the SELECT reported"""
+    status, data = mail.select(folder, readonly=readonly)
+    try:
+        messages = int(data[-1])
+    except (TypeError, ValueError, IndexError):
+        messages = None
+    return status, MailboxStatus(get_uid_next(mail), get_uid_validity(mail), messages, get_highest_modseq(mail))
+
+async def run_imap(func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking imaplib call on the IMAP thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_imap_executor, functools.partial(func, *args, **kwargs))
+
+class AsyncIMAPClient:
+    """
+    Asyncio facade over an imaplib connection
+    
+    Each command runs on the bounded IMAP thread pool, so a slow server never
+    blocks the event loop. Commands on one client must be awaited sequentially.
+    """
+    
+    def __init__(self, mail: imaplib.IMAP4, email_addr: str):
+        self.mail = mail
+        self.email_addr = email_addr
+        self.selected_folder: Optional[str] = None
+        # Counters of the selected folder when it was selected
+        self.selected_status: Optional[MailboxStatus] = None
+    
+    def supports(self, capability: str) -> bool:
+        return capability in self.mail.capabilities
+    
+    @classmethod
+    async def connect(cls, email_addr: str, access_token: str) -> "AsyncIMAPClient":
+        mail = await run_imap(open_imap_connection, email_addr, access_token)
+        return cls(mail, email_addr)
+    
+    async def select(self, folder: str = "INBOX", readonly: bool = False) -> Optional[int]:
+        """Select a folder and return its UIDVALIDITY"""
+        logger.info(f"Selecting {folder} for {self.email_addr}")
+        status, selected_status = await run_imap(select_folder, self.mail, folder, readonly)
+        logger.info(f"Select result: {status} UIDVALIDITY={selected_status.uid_validity}")
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"SELECT {folder} failed: {status}")
+        self.selected_folder = folder
+        self.selected_status = selected_status
+        return selected_status.uid_validity
+    
+    async def status(self, folder: str = "INBOX") -> Optional[MailboxStatus]:
+        return await run_imap(mailbox_status, self.mail, folder)
+    
+    async def search_new_uids(self, last_uid: int) -> Optional[List[int]]:
+        return await run_imap(search_new_uids, self.mail, last_uid)
+    
+    async def fetch_flags(
+        self,
+        max_uid: int,
+        changed_since: Optional[int] = None
+    ) -> Optional[Tuple[List[FetchedMessage], List[int]]]:
+        return await run_imap(fetch_flags, self.mail, max_uid, changed_since, self.supports("QRESYNC"))
+    
+    async def search_uid_by_message_id(self, message_id: str) -> Optional[int]:
+        return await run_imap(search_uid_by_message_id, self.mail, message_id)
+    
+    async def fetch_uid_batch(self, uids: List[int], items: str = '(UID RFC822)') -> Optional[List[FetchedMessage]]:
+        return await run_imap(fetch_uid_batch, self.mail, uids, items)
+    
+    async def logout(self):
+        """Close the selected folder and log out, ignoring errors on a dead connection"""
+        def _logout(mail: imaplib.IMAP4, close: bool):
+            try:
+                if close:
+                    mail.close()
+            except Exception:
+                pass
+            try:
+                mail.logout()
+            except Exception:
+                pass
+        
+        await run_imap(_logout, self.mail, self.selected_folder is not None)
+        self.selected_folder = None
+        self.selected_status = None
@@ -0,0 +1,287 @@
+"""
+Durable job queue backed by the jobs table
+
+The API enqueues jobs and worker processes (app.worker) claim them. A claim is
+a lease: the worker owns the job until lease_expires_at and extends the lease
+while it runs. A job whose worker died is reclaimed by another worker once its
+lease expires. Failed jobs are retried with exponential backoff until they run
+out of attempts.
+
+Claims use a conditional UPDATE on the job's previous state, so two workers can
+never both claim the same job, whatever the database.
+"""
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Any, Collection, Dict, List, Optional
+
+from sqlalchemy import select, insert, update, delete, and_, or_, exists, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.core.config import settings
+from app.db.models import Job, generate_uuid
+from app.email.scheduler import PRIORITY_NORMAL
+from app.email.sharding import account_shard
+from app.email.writer import insert_ignoring_duplicates
+
+logger = logging.getLogger(__name__)
+
+SYNC_ACCOUNT = "sync_account"
+# Re-categorization of stored emails (app.email.recategorize); account_id and
+# user_id are its scope, either or both None, and payload names who gets progress
+RECATEGORIZE = "recategorize"
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+async def enqueue_job(
+    db: AsyncSession,
+    kind: str,
+    account_id: str,
+    user_id: str,
+    priority: int = PRIORITY_NORMAL
+) -> Job:
+    """
+    Queue a job, or return the job of the same kind already queued for the account
+    
+    A request with a higher priority than the queued job raises its priority
+    and makes it runnable right away.
+    """
+    now = datetime.now()
+    await db.execute(
+        insert_ignoring_duplicates(db, Job),
+        [{
+            "id": generate_uuid(),
+            "kind": kind,
+            "account_id": account_id,
+            "user_id": user_id,
+            "priority": priority,
+            "status": "queued",
+            "attempts": 0,
+            "run_at": now
+        }]
+    )
+    
+    queued = and_(Job.kind == kind, Job.account_id == account_id, Job.status == "queued")
+    await db.execute(update(Job).where(queued, Job.priority > priority).values(priority=priority, run_at=now))
+    await db.commit()
+    
+    result = await db.execute(select(Job).where(queued))
+    return result.scalars().first()
+
+async def enqueue_sync(db: AsyncSession, account_id: str, user_id: str, priority: int = PRIORITY_NORMAL) -> Job:
+    return await enqueue_job(db, SYNC_ACCOUNT, account_id, user_id, priority)
+
+async def enqueue_exclusive_job(
+    db: AsyncSession,
+    kind: str,
+    account_id: Optional[str],
+    user_id: Optional[str],
+    payload: Optional[str] = None
+) -> Optional[Job]:
+    """
+    Queue a job unless one of the same kind and scope is queued or running;
+    returns None in that case
+    
+    The check and the insert are one statement, so concurrent requests from
+    several API processes queue a single job.
+    """
+    job_id = generate_uuid()
+    same_scope = select(Job.id).where(
+        Job.kind == kind,
+        Job.account_id == account_id,
+        Job.user_id == user_id,
+        Job.status.in_(("queued", "running"))
+    )
+    values = {
+        "id": job_id,
+        "kind": kind,
+        "account_id": account_id,
+        "user_id": user_id,
+        "payload": payload,
+        "priority": PRIORITY_NORMAL,
+        "status": "queued",
+        "attempts": 0,
+        "run_at": datetime.now()
+    }
+    columns = [getattr(Job, name) for name in values]
+    row = select(*(literal(value, column.type) for value, column in zip(values.values(), columns)))
+    await db.execute(insert(Job).from_select(columns, row.where(~exists(same_scope))))
+    await db.commit()
+    
+    return (await db.execute(select(Job).where(Job.id == job_id))).scalars().first()
+
+async def get_sync_status(db: AsyncSession, account_id: str) -> Dict[str, Any]:
+    """
+    Sync state of an account from its jobs
+    
+    status is running while a worker holds a live lease on a sync, queued while
+    one waits, and idle otherwise. follow_up_queued is set when a sync is
+    queued behind a running one.
+    """
+    now = datetime.now()
+    query = select(Job).where(
+        Job.kind == SYNC_ACCOUNT,
+        Job.account_id == account_id,
+        or_(Job.status == "queued", and_(Job.status == "running", Job.lease_expires_at >= now))
+    )
+    jobs = {job.status: job for job in (await db.execute(query)).scalars().all()}
+    
+    running = jobs.get("running")
+    queued = jobs.get("queued")
+    current = running or queued
+    return {
+        "account_id": account_id,
+        "status": current.status if current else "idle",
+        "job_id": current.id if current else None,
+        "attempts": current.attempts if current else 0,
+        "last_error": current.last_error if current else None,
+        "follow_up_queued": running is not None and queued is not None
+    }
+
+async def claim_jobs(
+    db: AsyncSession,
+    worker_id: str,
+    limit: int,
+    kind: str = SYNC_ACCOUNT,
+    shards: Optional[Collection[str]] = None
+) -> List[Job]:
+    """
+    Lease up to limit runnable jobs: queued and due, or running with an expired lease
+    
+    A job is not runnable while another job of its kind for the same account
+    holds a live lease, so an account is only ever synced by one worker at a time. With
+    shards, only jobs for accounts in those shards are claimed.
+    """
+    now = datetime.now()
+    other = aliased(Job)
+    account_busy = exists().where(
+        other.kind == Job.kind,
+        other.account_id == Job.account_id,
+        other.id != Job.id,
+        other.status == "running",
+        other.lease_expires_at >= now
+    )
+    runnable = and_(
+        or_(
+            and_(Job.status == "queued", Job.run_at <= now),
+            and_(Job.status == "running", Job.lease_expires_at < now)
+        ),
+        ~account_busy
+    )
+    query = select(Job.id, Job.account_id, Job.status, Job.attempts).where(
+        Job.kind == kind, runnable
+    ).order_by(Job.priority, Job.run_at).limit(limit)
+    if shards is not None:
+        query = query.where(account_shard(Job.account_id).in_(shards))
+    candidates = (await db.execute(query)).all()
+    
+    claimed_ids = []
+    claimed_accounts = set()
+    lease_expires_at = now + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+    for job_id, account_id, status, attempts in candidates:
+        if account_id in claimed_accounts:
+            continue
+        
+        # Only succeeds if no other worker changed the job since it was read
+        claim = update(Job).where(Job.id == job_id, Job.status == status, Job.attempts == attempts, runnable)
+        if status == "running" and attempts >= settings.JOB_MAX_ATTEMPTS:
+            # The job's worker died on every attempt
+            await db.execute(claim.values(
+                status="failed", lease_expires_at=None, finished_at=now, last_error="Lease expired"
+            ))
+            continue
+        
+        result = await db.execute(claim.values(
+            status="running",
+            attempts=attempts + 1,
+            locked_by=worker_id,
+            lease_expires_at=lease_expires_at
+        ))
+        if result.rowcount == 1:
+            claimed_ids.append(job_id)
+            claimed_accounts.add(account_id)
+    await db.commit()
+    
+    if not claimed_ids:
+        return []
+    result = await db.execute(select(Job).where(Job.id.in_(claimed_ids)).order_by(Job.priority, Job.run_at))
+    return list(result.scalars().all())
+
+async def extend_leases(db: AsyncSession, worker_id: str, job_ids: List[str]):
+    """Heartbeat for running jobs so they are not reclaimed"""
+    if not job_ids:
+        return
+    await db.execute(
+        update(Job).where(Job.id.in_(job_ids), Job.locked_by == worker_id, Job.status == "running").values(
+            lease_expires_at=datetime.now() + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+        )
+    )
+    await db.commit()
+
+async def complete_job(db: AsyncSession, job_id: str, worker_id: str):
+    await db.execute(
+        update(Job).where(Job.id == job_id, Job.locked_by == worker_id).values(
+            status="done", lease_expires_at=None, finished_at=datetime.now()
+        )
+    )
+    await db.commit()
+
+async def fail_job(db: AsyncSession, job_id: str, worker_id: str, error: str):
+    """Queue a failed job for a retry with backoff, or mark it failed after JOB_MAX_ATTEMPTS"""
+    result = await db.execute(select(Job).where(Job.id == job_id, Job.locked_by == worker_id))
+    job = result.scalars().first()
+    if not job:
+        return
+    
+    job.last_error = error
+    job.lease_expires_at = None
+    
+    # A newer request for the account is already queued and covers the retry
+    query = select(Job.id).where(
+        Job.kind == job.kind, Job.account_id == job.account_id, Job.user_id == job.user_id, Job.status == "queued"
+    )
+    superseded = (await db.execute(query)).first() is not None
+    
+    if job.attempts >= settings.JOB_MAX_ATTEMPTS or superseded:
+        job.status = "failed"
+        job.finished_at = datetime.now()
+        if not superseded:
+            logger.error(f"Job {job.id} ({job.kind} {job.account_id}) failed after {job.attempts} attempts: {error}")
+    else:
+        job.status = "queued"
+        delay = settings.JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1)
+        job.run_at = datetime.now() + timedelta(seconds=delay)
+        logger.warning(f"Job {job.id} ({job.kind} {job.account_id}) failed, retrying in {delay}s: {error}")
+    await db.commit()
+
+async def release_job(db: AsyncSession, job_id: str, worker_id: str):
+    """Hand a claimed job back to the queue without counting the attempt, e.g. when it could not be started"""
+    result = await db.execute(select(Job).where(Job.id == job_id, Job.locked_by == worker_id, Job.status == "running"))
+    job = result.scalars().first()
+    if not job:
+        return
+    
+    job.lease_expires_at = None
+    
+    # A newer request for the account is already queued and covers this one
+    query = select(Job.id).where(
+        Job.kind == job.kind, Job.account_id == job.account_id, Job.user_id == job.user_id, Job.status == "queued"
+    )
+    if (await db.execute(query)).first() is not None:
+        job.status = "failed"
+        job.finished_at = datetime.now()
+        job.last_error = "Superseded"
+    else:
+        job.status = "queued"
+        job.attempts = max(0, job.attempts - 1)
+    await db.commit()
+
+async def purge_finished_jobs(db: AsyncSession, older_than: timedelta):
+    """Delete done and failed jobs finished before older_than ago"""
+    await db.execute(
+        delete(Job).where(Job.status.in_(("done", "failed")), Job.finished_at < datetime.now() - older_than)
+    )
+    await db.commit()
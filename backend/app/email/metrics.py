@@ -0,0 +1,80 @@
+"""
+Prometheus metrics for email sync
+
+Each sync phase is timed with observe_phase, which also counts the phase's
+exceptions by type. Rates such as messages per second come from the counters
+in PromQL, e.g. rate(email_sync_messages_total{stage="stored"}[5m]).
+"""
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+# Phases: token_refresh, imap_connect, status, select, flags, search, fetch, parse,
+# categorize, db_write, notify, and sync for a whole account sync
+SYNC_PHASE_SECONDS = Histogram(
+    "email_sync_phase_seconds",
+    "Time spent in each email sync phase",
+    ["phase"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+SYNC_ERRORS = Counter(
+    "email_sync_errors_total",
+    "Exceptions raised in email sync phases",
+    ["phase", "error"]
+)
+# Stages: fetched, parsed, stored, notified
+SYNC_MESSAGES = Counter(
+    "email_sync_messages_total",
+    "Messages passing through each sync stage",
+    ["stage"]
+)
+SYNC_FETCHED_BYTES = Counter(
+    "email_sync_fetched_bytes_total",
+    "Message bytes downloaded from IMAP servers"
+)
+SYNC_RUNS = Counter(
+    "email_sync_runs_total",
+    "Account syncs by result",
+    ["result"]
+)
+
+@contextmanager
+def observe_phase(phase: str) -> Iterator[None]:
+    """Time a sync phase and count the exceptions it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        SYNC_ERRORS.labels(phase, type(e).__name__).inc()
+        raise
+    finally:
+        SYNC_PHASE_SECONDS.labels(phase).observe(time.perf_counter() - start)
+
+class SyncLagCollector:
+    """Reports seconds since the last successful sync of each account at scrape time"""
+    
+    def __init__(self):
+        self.last_success: Dict[str, float] = {}
+    
+    def record_success(self, account_id: str):
+        self.last_success[account_id] = time.time()
+    
+    def forget(self, account_id: str):
+        self.last_success.pop(account_id, None)
+    
+    def collect(self):
+        gauge = GaugeMetricFamily(
+            "email_sync_lag_seconds",
+            "Seconds since the last successful sync of an account",
+            labels=["account_id"]
+        )
+        now = time.time()
+        for account_id, last_success in list(self.last_success.items()):
+            gauge.add_metric([account_id], now - last_success)
+        yield gauge
+
+sync_lag = SyncLagCollector()
+REGISTRY.register(sync_lag)
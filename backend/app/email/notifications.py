@@ -0,0 +1,136 @@
+"""
+WebSocket notifications and presence shared between processes
+
+Syncs run in sync workers, which may be separate processes without the
+WebSockets. Their notifications are written to the notifications table, and
+every API process relays the rows added since it started to the users
+connected to it. Rows are kept for NOTIFICATION_RETENTION so a slow API
+process still sees them, then purged.
+
+In the other direction, API processes record the users with an open WebSocket
+in user_presence so workers can give those users priority. Rows are renewed
+while the process runs and ignored once they are older than
+SYNC_NODE_TTL_SECONDS, like the heartbeats of sync nodes.
+"""
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.models import Notification, UserPresence
+from app.db.session import AsyncSessionLocal
+from app.email.writer import insert_ignoring_duplicates
+
+logger = logging.getLogger(__name__)
+
+# Relayed notifications are purged after this
+NOTIFICATION_RETENTION = timedelta(minutes=5)
+
+# Rows read per relay query
+RELAY_BATCH_SIZE = 500
+
+async def queue_notifications(db: AsyncSession, user_id: str, messages: List[Dict[str, Any]]):
+    """Queue messages for the user's WebSockets, whichever API process holds them"""
+    if not messages:
+        return
+    now = datetime.now()
+    await db.execute(
+        Notification.__table__.insert(),
+        [{"user_id": user_id, "payload": json.dumps(message), "created_at": now} for message in messages]
+    )
+    await db.commit()
+
+async def publish_notifications(user_id: str, messages: List[Dict[str, Any]]):
+    """
+    Queue messages in a session of their own and finish the write even if the
+    caller is cancelled, so an interrupted commit never leaves the database locked
+    """
+    async def write():
+        async with AsyncSessionLocal() as db:
+            await queue_notifications(db, user_id, messages)
+    
+    task = asyncio.ensure_future(write())
+    try:
+        await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await task
+        raise
+
+async def connected_users(db: AsyncSession, user_ids: Optional[Iterable[str]] = None) -> Set[str]:
+    """Users with a WebSocket open on a live API process, optionally only among user_ids"""
+    live_after = datetime.now() - timedelta(seconds=settings.SYNC_NODE_TTL_SECONDS)
+    query = select(UserPresence.user_id).where(UserPresence.seen_at >= live_after).distinct()
+    if user_ids is not None:
+        query = query.where(UserPresence.user_id.in_(list(user_ids)))
+    return set((await db.execute(query)).scalars().all())
+
+async def is_user_connected(db: AsyncSession, user_id: str) -> bool:
+    """Whether the user has a WebSocket open"""
+    return bool(await connected_users(db, [user_id]))
+
+async def mark_connected(db: AsyncSession, node_id: str, user_ids: Iterable[str]):
+    """Record or renew the presence of users connected to this API process"""
+    now = datetime.now()
+    rows = [{"user_id": user_id, "node_id": node_id, "seen_at": now} for user_id in user_ids]
+    if not rows:
+        return
+    await db.execute(insert_ignoring_duplicates(db, UserPresence), rows)
+    await db.execute(
+        update(UserPresence).where(
+            UserPresence.node_id == node_id, UserPresence.user_id.in_([row["user_id"] for row in rows])
+        ).values(seen_at=now)
+    )
+    await db.commit()
+
+async def mark_disconnected(db: AsyncSession, node_id: str, user_id: str):
+    """Remove a user's presence once their last WebSocket on this process closed"""
+    await db.execute(delete(UserPresence).where(UserPresence.node_id == node_id, UserPresence.user_id == user_id))
+    await db.commit()
+
+async def relay_notifications(manager, node_id: str):
+    """
+    Deliver queued notifications to the WebSockets in manager, an API process's
+    ConnectionManager, and keep its users' presence alive
+    """
+    async with AsyncSessionLocal() as db:
+        # Only notifications queued from now on are for this process
+        last_id = (await db.execute(select(func.max(Notification.id)))).scalar() or 0
+    last_heartbeat = 0.0
+    
+    while True:
+        try:
+            async with AsyncSessionLocal() as db:
+                query = select(Notification).where(
+                    Notification.id > last_id
+                ).order_by(Notification.id).limit(RELAY_BATCH_SIZE)
+                notifications = (await db.execute(query)).scalars().all()
+                for notification in notifications:
+                    last_id = notification.id
+                    if notification.user_id in manager.active_connections:
+                        await manager.send_personal_message(json.loads(notification.payload), notification.user_id)
+                
+                if time.monotonic() - last_heartbeat >= settings.SYNC_NODE_TTL_SECONDS / 3:
+                    last_heartbeat = time.monotonic()
+                    await mark_connected(db, node_id, list(manager.active_connections))
+                    
+                    # Whichever process gets here first removes dead presence and old notifications
+                    now = datetime.now()
+                    expired_before = now - timedelta(seconds=settings.SYNC_NODE_TTL_SECONDS)
+                    await db.execute(delete(UserPresence).where(UserPresence.seen_at < expired_before))
+                    await db.execute(delete(Notification).where(Notification.created_at < now - NOTIFICATION_RETENTION))
+                    await db.commit()
+            
+            if len(notifications) == RELAY_BATCH_SIZE:
+                # More are waiting
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error relaying notifications: {str(e)}")
+        await asyncio.sleep(settings.NOTIFICATION_POLL_SECONDS)
@@ -0,0 +1,219 @@
+"""
+MIME parsing for synced messages
+
+This module only depends on the standard library so it can be imported cheaply
+by the worker processes that parse messages off the event loop.
+"""
+import email as email_module
+import logging
+import os
+import uuid
+from datetime import datetime
+from email.header import decode_header
+from email.parser import BytesHeaderParser
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from app.email.attachment_store import ATTACHMENTS_DIR, store_part
+
+logger = logging.getLogger(__name__)
+
+class ParsedMessage(NamedTuple):
+    email_id: str
+    message_id: str
+    subject: str
+    sender: str
+    recipients: str
+    date_received: datetime
+    body_text: str
+    body_html: str
+    has_attachments: Optional[bool]  # None when only the headers were parsed
+    attachments: List[Dict[str, Any]]  # Attachment rows for files already written to disk
+    headers: Dict[str, str]  # Decoded headers by lowercase name, repeated headers joined by newlines
+
+def decode_header_value(value: str) -> str:
+    """Decode the first chunk of an RFC 2047 encoded header"""
+    decoded = decode_header(value)
+    if decoded[0][1] is not None:
+        # If encoded, decode according to encoding
+        return decoded[0][0].decode(decoded[0][1])
+    # Otherwise get value directly
+    value = decoded[0][0]
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='replace')
+    return value
+
+def extract_headers(msg: email_module.message.Message) -> Dict[str, str]:
+    """Collect decoded header values by lowercase name for header rules"""
+    headers: Dict[str, str] = {}
+    for name, value in msg.items():
+        try:
+            value = decode_header_value(value)
+        except Exception:
+            value = str(value)
+        name = name.lower()
+        headers[name] = f"{headers[name]}\n{value}" if name in headers else value
+    return headers
+
+def extract_email_bodies(msg: email_module.message.Message) -> Tuple[str, str]:
+    """Extract the plain text and HTML bodies of a message"""
+    email_body = ""
+    html_body = ""
+    
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            content_disposition = str(part.get("Content-Disposition"))
+            
+            # Skip attachments for now
+            if "attachment" in content_disposition:
+                continue
+            
+            try:
+                if content_type == "text/plain":
+                    body = part.get_payload(decode=True)
+                    charset = part.get_content_charset()
+                    if charset:
+                        body = body.decode(charset, errors='replace')
+                    else:
+                        body = body.decode('utf-8', errors='replace')
+                    email_body = body
+                elif content_type == "text/html":
+                    body = part.get_payload(decode=True)
+                    charset = part.get_content_charset()
+                    if charset:
+                        body = body.decode(charset, errors='replace')
+                    else:
+                        body = body.decode('utf-8', errors='replace')
+                    html_body = body
+            except Exception as e:
+                logger.error(f"Error decoding email part: {str(e)}")
+    else:
+        # Not multipart
+        content_type = msg.get_content_type()
+        try:
+            body = msg.get_payload(decode=True)
+            charset = msg.get_content_charset()
+            if charset:
+                body = body.decode(charset, errors='replace')
+            else:
+                body = body.decode('utf-8', errors='replace')
+                
+            if content_type == "text/plain":
+                email_body = body
+            elif content_type == "text/html":
+                html_body = body
+        except Exception as e:
+            logger.error(f"Error decoding email content: {str(e)}")
+    
+    return email_body, html_body
+
+def has_attachment_parts(msg: email_module.message.Message) -> bool:
+    """Check whether a fully downloaded message carries attachments"""
+    return msg.is_multipart() and any(
+        part.get_content_disposition() == 'attachment' for part in msg.walk()
+    )
+
+def write_email_attachments(
+    msg: email_module.message.Message,
+    email_id: str,
+    attachments_dir: str = ATTACHMENTS_DIR
+) -> List[Dict[str, Any]]:
+    """Write the attachments of a message to the attachment store and return their attachment rows"""
+    if not msg.is_multipart():
+        return []
+    
+    rows = []
+    for part in msg.walk():
+        if part.get_content_disposition() == 'attachment':
+            filename = part.get_filename()
+            if not filename:
+                continue
+            
+            # Sanitize filename
+            filename = os.path.basename(filename)
+            
+            # Save attachment, shared with every other email carrying the same content
+            content_hash, file_path, size = store_part(part, attachments_dir)
+            
+            # Create attachment record
+            rows.append({
+                "id": str(uuid.uuid4()),
+                "email_id": email_id,
+                "filename": filename,
+                "content_type": part.get_content_type(),
+                "file_path": file_path,
+                "content_hash": content_hash,
+                "size": size
+            })
+    
+    return rows
+
+def extract_message_id(raw_email: bytes) -> str:
+    """Read the Message-ID from the header block only, without parsing the body"""
+    end = raw_email.find(b"\r\n\r\n")
+    if end == -1:
+        end = raw_email.find(b"\n\n")
+    header_block = raw_email if end == -1 else raw_email[:end]
+    return BytesHeaderParser().parsebytes(header_block).get("Message-ID", "")
+
+def parse_message(
+    raw_email: bytes,
+    email_id: str,
+    headers_only: bool = False,
+    attachments_dir: str = ATTACHMENTS_DIR
+) -> ParsedMessage:
+    """
+    Parse a raw RFC822 message into a ParsedMessage
+    
+    With headers_only, raw_email only holds the header block and the body and
+    attachments are left for load_email_body.
+    """
+    msg = email_module.message_from_bytes(raw_email)
+    
+    # Get date
+    date_str = msg.get("Date", "")
+    try:
+        # Try to parse the date
+        date_received = email_module.utils.parsedate_to_datetime(date_str)
+    except:
+        # If parsing fails, use current time
+        date_received = datetime.now()
+    
+    # Get email content
+    if headers_only:
+        email_body, html_body = "", ""
+        has_attachments = None
+        attachments = []
+    else:
+        email_body, html_body = extract_email_bodies(msg)
+        has_attachments = has_attachment_parts(msg)
+        attachments = write_email_attachments(msg, email_id, attachments_dir)
+    
+    return ParsedMessage(
+        email_id=email_id,
+        message_id=msg.get("Message-ID", ""),
+        subject=decode_header_value(msg.get("Subject", "")),
+        sender=decode_header_value(msg.get("From", "")),
+        recipients=msg.get("To", ""),
+        date_received=date_received,
+        body_text=email_body,
+        body_html=html_body,
+        has_attachments=has_attachments,
+        attachments=attachments,
+        headers=extract_headers(msg)
+    )
+
+def parse_messages(
+    items: List[Tuple[bytes, str]],
+    headers_only: bool = False,
+    attachments_dir: str = ATTACHMENTS_DIR
+) -> List[Optional[ParsedMessage]]:
+    """Parse (raw message, email ID) pairs; messages that fail to parse come back as None"""
+    parsed = []
+    for raw_email, email_id in items:
+        try:
+            parsed.append(parse_message(raw_email, email_id, headers_only, attachments_dir))
+        except Exception as e:
+            logger.error(f"Error parsing email: {str(e)}")
+            parsed.append(None)
+    return parsed
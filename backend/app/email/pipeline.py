@@ -0,0 +1,21 @@
+import asyncio
+from typing import Awaitable
+
+# Marks the end of a stage's output on its queue
+STOP = object()
+
+async def run_pipeline(*stages: Awaitable):
+    """
+    Run pipeline stages concurrently
+    
+    Stages talk through bounded asyncio queues and signal completion by putting
+    STOP. If any stage fails, the others are cancelled and the error is raised.
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
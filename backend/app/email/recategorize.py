@@ -0,0 +1,158 @@
+"""
+Re-categorization of stored emails
+
+Emails are read in chunks ordered by primary key, each chunk starting after the
+last ID of the previous one, so memory use and query cost do not grow with the
+table. Changed categories are written with one executemany UPDATE per chunk in
+its own short transaction, which keeps SQLite writers from waiting on the job.
+
+Jobs are queued in the jobs table by queue_recategorization and run by sync
+workers, so a job survives restarts and one scope is only processed once at a
+time across processes.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional
+
+from sqlalchemy import select, update, func, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.db.models import Email, EmailAccount, Job
+from app.email.jobs import RECATEGORIZE, enqueue_exclusive_job
+from app.email.notifications import queue_notifications
+from app.email.service import categorize_many, categorization_reads_body
+from app.email.user_rules import UserRuleIndex, user_rule_cache
+
+logger = logging.getLogger(__name__)
+
+# Seconds between progress messages
+PROGRESS_INTERVAL = 1.0
+
+async def queue_recategorization(
+    db: AsyncSession,
+    notify_user_id: str,
+    user_id: Optional[str] = None,
+    account_id: Optional[str] = None
+) -> Optional[Job]:
+    """Queue a re-categorization job; None if one is already queued or running for the scope"""
+    payload = json.dumps({"notify_user_id": notify_user_id})
+    return await enqueue_exclusive_job(db, RECATEGORIZE, account_id, user_id, payload)
+
+async def run_recategorize_job(job: Job):
+    """Run a claimed re-categorization job"""
+    payload = json.loads(job.payload or "{}")
+    await recategorize_emails(job.id, payload.get("notify_user_id"), user_id=job.user_id, account_id=job.account_id)
+
+async def recategorize_emails(
+    job_id: str,
+    notify_user_id: str,
+    user_id: Optional[str] = None,
+    account_id: Optional[str] = None,
+    chunk_size: Optional[int] = None
+):
+    """
+    Re-run categorization over stored emails
+    
+    The scope is one account, all accounts of user_id, or every email when both
+    are None. Emails whose category was set by the user are left alone. Progress
+    goes to notify_user_id over the WebSocket. A failure is reported and raised,
+    so the job is retried.
+    """
+    chunk_size = chunk_size or settings.RECATEGORIZE_CHUNK_SIZE
+    filters = [Email.category_manual.isnot(True)]
+    if account_id:
+        filters.append(Email.email_account_id == account_id)
+    if user_id:
+        filters.append(EmailAccount.user_id == user_id)
+    
+    columns = [Email.id, Email.subject, Email.sender, Email.category, EmailAccount.user_id]
+    if categorization_reads_body():
+        # Bodies are only read when the categorizer uses them
+        columns.append(Email.body_text)
+    
+    # Only manual categories are protected; rows the user changed after they were read are skipped
+    emails_table = Email.__table__
+    update_query = update(emails_table).where(
+        emails_table.c.id == bindparam("b_id"),
+        emails_table.c.category_manual.isnot(True)
+    ).values(category=bindparam("b_category"))
+    
+    processed = 0
+    updated = 0
+    last_sent = 0.0
+    
+    async def send_progress(status: str, total: Optional[int], error: Optional[str] = None):
+        if not notify_user_id:
+            return
+        # Relayed by whichever API process holds the user's WebSocket
+        async with AsyncSessionLocal() as db:
+            await queue_notifications(db, notify_user_id, [{
+                "type": "recategorize_progress",
+                "data": {
+                    "job_id": job_id,
+                    "status": status,
+                    "processed": processed,
+                    "updated": updated,
+                    "total": total,
+                    "error": error
+                }
+            }])
+    
+    total = None
+    try:
+        async with AsyncSessionLocal() as db:
+            count_query = select(func.count(Email.id)).join(
+                EmailAccount, Email.email_account_id == EmailAccount.id
+            ).where(*filters)
+            total = (await db.execute(count_query)).scalar()
+        
+        logger.info(f"Re-categorizing {total} emails (job {job_id})")
+        await send_progress("running", total)
+        
+        rule_indexes: Dict[str, UserRuleIndex] = {}
+        last_id = ""
+        while True:
+            async with AsyncSessionLocal() as db:
+                query = select(*columns).join(
+                    EmailAccount, Email.email_account_id == EmailAccount.id
+                ).where(Email.id > last_id, *filters).order_by(Email.id).limit(chunk_size)
+                rows = (await db.execute(query)).all()
+                if not rows:
+                    break
+                
+                for row_user_id in {row.user_id for row in rows} - rule_indexes.keys():
+                    rule_indexes[row_user_id] = await user_rule_cache.get_index(db, row_user_id)
+                
+                changes = []
+                categories = categorize_many(row._mapping for row in rows)
+                for row, category in zip(rows, categories):
+                    # Stored emails have no headers, so header rules do not apply here
+                    category = rule_indexes[row.user_id].categorize(row.sender, row.subject) or category
+                    if category != row.category:
+                        changes.append({"b_id": row.id, "b_category": category})
+                
+                if changes:
+                    await db.execute(update_query, changes)
+                    await db.commit()
+            
+            last_id = rows[-1].id
+            processed += len(rows)
+            updated += len(changes)
+            
+            if time.monotonic() - last_sent >= PROGRESS_INTERVAL:
+                last_sent = time.monotonic()
+                await send_progress("running", total)
+            
+            # Let requests run between chunks
+            await asyncio.sleep(0)
+        
+        logger.info(f"Re-categorized {processed} emails, {updated} changed (job {job_id})")
+        await send_progress("completed", total)
+    except Exception as e:
+        logger.error(f"Error re-categorizing emails (job {job_id}): {str(e)}")
+        await send_progress("failed", total, str(e))
+        raise
@@ -0,0 +1,101 @@
+import asyncio
+import itertools
+import logging
+import math
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Set
+
+logger = logging.getLogger(__name__)
+
+class SyncJob(NamedTuple):
+    account_id: str
+    user_id: str
+    host: str
+
+# Priorities for SyncScheduler.enqueue; lower runs first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+def update_arrival_rate(rate: float, new_messages: int, elapsed: float, window: float) -> float:
+    """
+    Fold one sync into an account's arrival rate (messages per hour)
+    
+    The observation is weighted by how much of the averaging window it covers,
+    so a sync after a long gap counts for more than one a minute after the last.
+    """
+    if elapsed <= 0:
+        return rate
+    observed = new_messages * 3600 / elapsed
+    weight = 1 - math.exp(-elapsed / window)
+    return weight * observed + (1 - weight) * rate
+
+def next_sync_interval(arrival_rate: float, min_interval: float, max_interval: float) -> float:
+    """Poll about as often as one new message is expected, within the bounds"""
+    if arrival_rate <= 0:
+        return max_interval
+    return min(max_interval, max(min_interval, 3600 / arrival_rate))
+
+class SyncScheduler:
+    """
+    Work queue that syncs accounts concurrently
+    
+    Every IMAP server has its own queue drained by at most provider_concurrency
+    workers, and all workers share a global limit of concurrency running
+    syncs, so a slow server never holds up accounts on the others. The limit is
+    per server rather than per mail domain, as that is where connections are
+    throttled. Queues are ordered by priority, then by the order accounts were
+    queued in.
+    """
+    
+    def __init__(
+        self,
+        sync_func: Callable[[str, str], Awaitable[None]],
+        concurrency: int,
+        provider_concurrency: int
+    ):
+        self.sync_func = sync_func
+        self.provider_concurrency = max(1, provider_concurrency)
+        self.global_limit = asyncio.Semaphore(max(1, concurrency))
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.workers: Dict[str, List[asyncio.Task]] = {}
+        self.sequence = itertools.count()
+        # Accounts queued or running, so an account is never synced twice at once
+        self.pending: Set[str] = set()
+    
+    def enqueue(self, account_id: str, user_id: str, host: str, priority: int = PRIORITY_NORMAL) -> bool:
+        """Queue an account synced from an IMAP host; returns False if it is already queued or running"""
+        if account_id in self.pending:
+            return False
+        
+        queue = self.queues.get(host)
+        if queue is None:
+            queue = self.queues[host] = asyncio.PriorityQueue()
+            self.workers[host] = [
+                asyncio.create_task(self._worker(queue))
+                for _ in range(self.provider_concurrency)
+            ]
+        
+        self.pending.add(account_id)
+        queue.put_nowait((priority, next(self.sequence), SyncJob(account_id, user_id, host)))
+        return True
+    
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            _, _, job = await queue.get()
+            try:
+                async with self.global_limit:
+                    await self.sync_func(job.account_id, job.user_id)
+            except Exception as e:
+                logger.error(f"Error syncing account {job.account_id}: {str(e)}")
+            finally:
+                self.pending.discard(job.account_id)
+                queue.task_done()
+    
+    async def stop(self):
+        """Cancel all workers"""
+        tasks = [task for tasks in self.workers.values() for task in tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.queues.clear()
+        self.workers.clear()
+        self.pending.clear()
@@ -1,26 +1,57 @@
-import base64
-import imaplib
-import requests
-import email as email_module
-from email.header import decode_header
-from email.parser import BytesParser
+import httpx
 import os
 import logging
-from datetime import datetime
-from typing import Optional, List, Dict, Any
+import math
+import multiprocessing
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Tuple, Iterable, Set
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update, delete, func, or_, bindparam
 
+from app.core.config import settings
 from app.db.session import AsyncSessionLocal
-from app.db.models import EmailAccount, Email, Attachment
+from app.db.models import EmailAccount, Email, Attachment, MailboxSyncState, generate_uuid
+from app.email.imap import (
+    AsyncIMAPClient, FetchedMessage, MailboxStatus, chunked, parse_fetch_size,
+    parse_fetch_flags, is_seen, bodystructure_has_attachments
+)
+from app.email.categorizer import build_categorizer
+from app.email.notifications import connected_users, is_user_connected, publish_notifications
+from app.email.metrics import (
+    SYNC_ERRORS, SYNC_FETCHED_BYTES, SYNC_MESSAGES, SYNC_RUNS, observe_phase, sync_lag
+)
+from app.email.parser import ParsedMessage, extract_message_id, parse_messages
+from app.email.pipeline import STOP, run_pipeline
+from app.email.jobs import enqueue_sync
+from app.email.sharding import ShardMembership, account_shard
+from app.email.scheduler import PRIORITY_HIGH, PRIORITY_NORMAL, next_sync_interval, update_arrival_rate
+from app.email.token_cache import TokenCache
+from app.email.user_rules import user_rule_cache
+from app.email.writer import EmailBatchWriter, release_attachment_files
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def get_access_token(client_id: str, refresh_token: str) -> str:
-    """Get access token from refresh token"""
+# CPU-bound MIME parsing runs in worker processes, created on first use
+_parse_executor: Optional[ProcessPoolExecutor] = None
+
+# Keyword categorizer, compiled once at import
+categorizer = build_categorizer(settings.CATEGORY_RULES_FILE)
+
+# Trained classifier loaded by load_classifier, None when disabled
+classifier_model = None
+# When the loaded model was saved, so a model trained by another process is picked up
+classifier_saved_at: Optional[float] = None
+
+# FETCH items for header-only sync: summary headers, MIME structure and size
+HEADER_FETCH_ITEMS = '(UID RFC822.SIZE FLAGS BODYSTRUCTURE BODY.PEEK[HEADER])'
+
+async def request_access_token(client_id: str, refresh_token: str) -> Dict[str, Any]:
+    """Exchange a refresh token at the token endpoint and return the full response"""
     data = {
         'client_id': client_id,
         'grant_type': 'refresh_token',
@@ -30,183 +61,180 @@ async def get_access_token(client_id: str, refresh_token: str) -> str:
     }
     
     try:
-        response = requests.post('https://login.live.com/oauth20_token.srf', data=data)
-        if response.status_code != 200:
-            logger.error(f"OAuth error: {response.status_code} {response.text}")
-            logger.error(f"Request data: {data}")
-        response.raise_for_status()
-        return response.json()['access_token']
+        with observe_phase("token_refresh"):
+            async with httpx.AsyncClient(timeout=30) as client:
+                response = await client.post('https://login.live.com/oauth20_token.srf', data=data)
+            if response.status_code != 200:
+                logger.error(f"OAuth error: {response.status_code} {response.text}")
+                logger.error(f"Request data: {data}")
+            response.raise_for_status()
+            return response.json()
     except Exception as e:
         logger.error(f"Error getting access token: {str(e)}")
         raise
 
-def generate_auth_string(user: str, token: str) -> str:
-    """Generate OAuth2 authentication string"""
-    auth_string = f"user={user}\1auth=Bearer {token}\1\1"
-    return auth_string
+# Access tokens shared by every sync and on-demand body download
+token_cache = TokenCache(
+    request_access_token,
+    refresh_margin=settings.TOKEN_REFRESH_MARGIN_SECONDS,
+    persist=settings.TOKEN_CACHE_PERSIST
+)
 
-async def process_email_message(
-    msg: email_module.message.Message,
+def build_email_record(
+    parsed: ParsedMessage,
     email_account_id: str,
-    db: AsyncSession
-) -> Optional[Email]:
-    """Process a single email message and save to database"""
+    uid: Optional[int] = None,
+    folder: str = "INBOX",
+    size: Optional[int] = None,
+    headers_only: bool = False,
+    has_attachments: Optional[bool] = None,
+    category: Optional[str] = None,
+    is_read: bool = False
+) -> Dict[str, Any]:
+    """
+    Build the emails row for a parsed message
+    
+    With headers_only, only the message headers were parsed: the summary row is
+    stored and the body and attachments are downloaded later by load_email_body.
+    """
+    if parsed.has_attachments is not None:
+        has_attachments = parsed.has_attachments
+    
+    # Determine category based on email properties
+    if category is None:
+        category = categorize_email(parsed.subject, parsed.sender, parsed.body_text)
+    
+    return {
+        "id": parsed.email_id,
+        "email_account_id": email_account_id,
+        "message_id": parsed.message_id,
+        "uid": uid,
+        "folder": folder,
+        "size": size,
+        "subject": parsed.subject,
+        "sender": parsed.sender,
+        "recipients": parsed.recipients,
+        "date_received": parsed.date_received,
+        "body_text": parsed.body_text,
+        "body_html": parsed.body_html,
+        "body_loaded": not headers_only,
+        "has_attachments": bool(has_attachments),
+        "is_read": is_read,
+        "category": category
+    }
+
+def get_parse_executor() -> Optional[ProcessPoolExecutor]:
+    """Return the MIME parsing process pool, creating it on first use"""
+    global _parse_executor
+    if settings.PARSE_WORKERS <= 0:
+        return None
+    if _parse_executor is None:
+        # spawn avoids forking a process that is running threads and an event loop
+        _parse_executor = ProcessPoolExecutor(
+            max_workers=settings.PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _parse_executor
+
+def shutdown_parse_executor():
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+        _parse_executor = None
+
+async def parse_raw_messages(items: List[Tuple[bytes, str]], headers_only: bool = False) -> List[Optional[ParsedMessage]]:
+    """Parse (raw message, email ID) pairs across the process pool, keeping their order"""
+    global _parse_executor
+    if not items:
+        return []
+    
+    executor = get_parse_executor()
+    if executor is None:
+        # Parsing writes attachment files, so keep it off the event loop thread
+        return await asyncio.to_thread(parse_messages, items, headers_only)
+    
+    loop = asyncio.get_running_loop()
+    chunk_size = math.ceil(len(items) / settings.PARSE_WORKERS)
+    futures = [
+        loop.run_in_executor(executor, parse_messages, chunk, headers_only)
+        for chunk in chunked(items, chunk_size)
+    ]
     try:
-        # Extract message ID
-        message_id = msg.get("Message-ID", "")
-        
-        # Check if this email already exists in the database
-        if message_id:
-            query = select(Email).where(
-                Email.message_id == message_id,
-                Email.email_account_id == email_account_id
-            )
-            result = await db.execute(query)
-            if result.scalars().first():
-                # Email already exists, skip processing
-                return None
-        
-        # Get subject
-        subject = decode_header(msg.get("Subject", ""))
-        if subject[0][1] is not None:
-            # If encoded, decode according to encoding
-            subject = subject[0][0].decode(subject[0][1])
-        else:
-            # Otherwise get subject directly
-            subject = subject[0][0]
-            if isinstance(subject, bytes):
-                subject = subject.decode('utf-8', errors='replace')
-        
-        # Get sender
-        from_ = decode_header(msg.get("From", ""))
-        if from_[0][1] is not None:
-            from_ = from_[0][0].decode(from_[0][1])
-        else:
-            from_ = from_[0][0]
-            if isinstance(from_, bytes):
-                from_ = from_.decode('utf-8', errors='replace')
-        
-        # Get recipients
-        to = msg.get("To", "")
-        
-        # Get date
-        date_str = msg.get("Date", "")
-        try:
-            # Try to parse the date
-            date_received = email_module.utils.parsedate_to_datetime(date_str)
-        except:
-            # If parsing fails, use current time
-            date_received = datetime.now()
-        
-        # Get email content
-        email_body = ""
-        html_body = ""
+        results = await asyncio.gather(*futures)
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); start a fresh pool next time
+        logger.error("MIME parsing process pool broke, parsing batch in-process")
+        _parse_executor = None
+        return await asyncio.to_thread(parse_messages, items, headers_only)
+    
+    return [parsed for chunk in results for parsed in chunk]
+
+async def find_existing_message_ids(
+    db: AsyncSession,
+    email_account_id: str,
+    message_ids: Iterable[str]
+) -> Set[str]:
+    """Return the message IDs that are already stored for an account, using one IN query per chunk"""
+    message_ids = [message_id for message_id in set(message_ids) if message_id]
+    existing = set()
+    for chunk in chunked(message_ids, 500):
+        query = select(Email.message_id).where(
+            Email.email_account_id == email_account_id,
+            Email.message_id.in_(chunk)
+        )
+        result = await db.execute(query)
+        existing.update(row[0] for row in result)
+    return existing
+
+async def load_email_body(email: Email, db: AsyncSession) -> bool:
+    """Download the body and attachments of an email synced in header-only mode"""
+    if email.body_loaded:
+        return True
+    
+    query = select(EmailAccount).where(EmailAccount.id == email.email_account_id)
+    result = await db.execute(query)
+    account = result.scalars().first()
+    if not account:
+        return False
+    
+    folder = email.folder or "INBOX"
+    access_token = await token_cache.get_token(account, db)
+    try:
+        client = await AsyncIMAPClient.connect(account.email_address, access_token)
+    except Exception:
+        token_cache.invalidate(account.id)
+        raise
+    try:
+        uid_validity = await client.select(folder, readonly=True)
+        sync_state = await get_sync_state(db, account.id, folder)
         
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-                
-                # Skip attachments for now
-                if "attachment" in content_disposition:
-                    continue
-                
-                try:
-                    if content_type == "text/plain":
-                        body = part.get_payload(decode=True)
-                        charset = part.get_content_charset()
-                        if charset:
-                            body = body.decode(charset, errors='replace')
-                        else:
-                            body = body.decode('utf-8', errors='replace')
-                        email_body = body
-                    elif content_type == "text/html":
-                        body = part.get_payload(decode=True)
-                        charset = part.get_content_charset()
-                        if charset:
-                            body = body.decode(charset, errors='replace')
-                        else:
-                            body = body.decode('utf-8', errors='replace')
-                        html_body = body
-                except Exception as e:
-                    logger.error(f"Error decoding email part: {str(e)}")
-        else:
-            # Not multipart
-            content_type = msg.get_content_type()
-            try:
-                body = msg.get_payload(decode=True)
-                charset = msg.get_content_charset()
-                if charset:
-                    body = body.decode(charset, errors='replace')
-                else:
-                    body = body.decode('utf-8', errors='replace')
-                    
-                if content_type == "text/plain":
-                    email_body = body
-                elif content_type == "text/html":
-                    html_body = body
-            except Exception as e:
-                logger.error(f"Error decoding email content: {str(e)}")
+        # Stored UIDs are only meaningful under the UIDVALIDITY they were synced with
+        uid = email.uid
+        if not uid or uid_validity is None or sync_state.uid_validity != uid_validity:
+            uid = await client.search_uid_by_message_id(email.message_id)
+        if not uid:
+            logger.warning(f"Message {email.message_id} no longer found in {account.email_address} {folder}")
+            return False
         
-        # Determine category based on email properties
-        category = categorize_email(subject, from_, email_body)
+        fetched = await client.fetch_uid_batch([uid], '(UID BODY.PEEK[])')
+        if not fetched or not fetched[0].literals:
+            logger.warning(f"Failed to fetch body of UID {uid} for {account.email_address}")
+            return False
         
-        # Create and save email
-        email = Email(
-            email_account_id=email_account_id,
-            message_id=message_id,
-            subject=subject,
-            sender=from_,
-            recipients=to,
-            date_received=date_received,
-            body_text=email_body,
-            body_html=html_body,
-            is_read=False,
-            category=category
-        )
+        parsed = (await parse_raw_messages([(fetched[0].literals[0], email.id)]))[0]
+        if parsed is None:
+            return False
         
-        db.add(email)
+        email.body_text, email.body_html = parsed.body_text, parsed.body_html
+        email.has_attachments = parsed.has_attachments
+        for row in parsed.attachments:
+            db.add(Attachment(**row))
+        email.uid = uid
+        email.body_loaded = True
         await db.commit()
-        await db.refresh(email)
-        
-        # Process attachments if any
-        if msg.is_multipart():
-            attachments_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "attachments")
-            os.makedirs(attachments_dir, exist_ok=True)
-            
-            for part in msg.walk():
-                if part.get_content_disposition() == 'attachment':
-                    filename = part.get_filename()
-                    if not filename:
-                        continue
-                    
-                    # Sanitize filename
-                    filename = os.path.basename(filename)
-                    
-                    # Create a unique path
-                    file_path = os.path.join(attachments_dir, f"{email.id}_{filename}")
-                    
-                    # Save attachment
-                    with open(file_path, 'wb') as f:
-                        f.write(part.get_payload(decode=True))
-                    
-                    # Create attachment record
-                    attachment = Attachment(
-                        email_id=email.id,
-                        filename=filename,
-                        content_type=part.get_content_type(),
-                        file_path=file_path,
-                        size=os.path.getsize(file_path)
-                    )
-                    
-                    db.add(attachment)
-            
-            await db.commit()
-        
-        return email
-    except Exception as e:
-        logger.error(f"Error processing email: {str(e)}")
-        return None
+        return True
+    finally:
+        await client.logout()
 
 def categorize_email(subject: str, sender: str, body: str) -> str:
     """
@@ -221,127 +249,656 @@ def categorize_email(subject: str, sender: str, body: str) -> str:
     - forums: Forum posts and mailing lists
     - spam: Potential spam
     """
-    subject_lower = subject.lower()
-    sender_lower = sender.lower()
+    return categorizer.categorize(subject, sender, body)
+
+def categorize_many(records: Iterable[Dict[str, Any]]) -> List[str]:
+    """
+    Categorize a batch of email records in one call
     
-    # Check for social media related emails
-    social_terms = ['facebook', 'twitter', 'instagram', 'linkedin', 'weibo', 'wechat', 'qq', 'tiktok']
-    if any(term in sender_lower or term in subject_lower for term in social_terms):
-        return "social"
-
-    # Check for promotions/marketing
-    promo_terms = ['promotion', 'discount', 'sale', 'off', 'deal', 'offer', '促销', '优惠', '折扣']
-    if any(term in subject_lower for term in promo_terms):
-        return "promotions"
+    Confident predictions of the trained classifier, when one is loaded, replace
+    the keyword categories.
+    """
+    records = list(records)
+    categories = categorizer.categorize_many(records)
+    if classifier_model is not None and records:
+        predictions = classifier_model.predict(records, settings.CLASSIFIER_MIN_CONFIDENCE)
+        categories = [predicted or category for predicted, category in zip(predictions, categories)]
+    return categories
+
+def categorization_reads_body() -> bool:
+    """Whether categorize_many looks at body_text"""
+    return classifier_model is not None or "body_text" in categorizer.matchers
+
+def saved_classifier_time() -> Optional[float]:
+    """Modification time of the saved classifier, None if there is none"""
+    from app.email.classifier import MODEL_DIR
+    try:
+        return os.path.getmtime(os.path.join(settings.CLASSIFIER_MODEL_DIR or MODEL_DIR, "meta.json"))
+    except OSError:
+        return None
+
+def load_classifier():
+    """Load the trained classifier if CLASSIFIER_ENABLED"""
+    global classifier_model, classifier_saved_at
+    if not settings.CLASSIFIER_ENABLED:
+        return
+    try:
+        # numpy is only needed when the classifier is enabled
+        from app.email.classifier import MODEL_DIR, NaiveBayesModel
+        classifier_saved_at = saved_classifier_time()
+        classifier_model = NaiveBayesModel.load(settings.CLASSIFIER_MODEL_DIR or MODEL_DIR)
+        logger.info(f"Loaded classifier with categories {classifier_model.classes}")
+    except FileNotFoundError:
+        logger.warning("No trained classifier found, run python -m app.email.classifier to train one")
+    except Exception as e:
+        logger.error(f"Error loading classifier: {str(e)}")
+
+async def retrain_classifier():
+    """Train the classifier on stored emails and start using it if enabled"""
+    global classifier_model, classifier_saved_at
+    from app.email.classifier import train_classifier
+    try:
+        model = await train_classifier()
+    except Exception as e:
+        logger.error(f"Error training classifier: {str(e)}")
+        return
+    if model is not None and settings.CLASSIFIER_ENABLED:
+        classifier_saved_at = saved_classifier_time()
+        classifier_model = model
+
+async def watch_classifier():
+    """Reload the classifier whenever another process, e.g. the API after training, saved a new one"""
+    if not settings.CLASSIFIER_ENABLED:
+        return
+    while True:
+        await asyncio.sleep(settings.CLASSIFIER_RELOAD_SECONDS)
+        try:
+            saved_at = await asyncio.to_thread(saved_classifier_time)
+            if saved_at is not None and saved_at != classifier_saved_at:
+                logger.info("Saved classifier changed, reloading it")
+                await asyncio.to_thread(load_classifier)
+        except Exception as e:
+            logger.error(f"Error checking for a new classifier: {str(e)}")
+
+async def get_sync_state(db: AsyncSession, email_account_id: str, folder: str) -> MailboxSyncState:
+    """Get the sync checkpoint for an account folder, creating it if missing"""
+    query = select(MailboxSyncState).where(
+        MailboxSyncState.email_account_id == email_account_id,
+        MailboxSyncState.folder == folder
+    )
+    result = await db.execute(query)
+    sync_state = result.scalars().first()
+    if not sync_state:
+        sync_state = MailboxSyncState(
+            email_account_id=email_account_id,
+            folder=folder,
+            last_uid=0
+        )
+        db.add(sync_state)
+    return sync_state
+
+def folder_unchanged(sync_state: MailboxSyncState, mailbox_status: Optional[MailboxStatus]) -> bool:
+    """Whether STATUS reports the same counters as when the folder was last fully synced"""
+    if mailbox_status is None or None in (mailbox_status.uid_next, mailbox_status.uid_validity, sync_state.uid_next):
+        return False
+    if sync_state.resume_high_uid is not None:
+        # An interrupted sync still has to finish
+        return False
+    return (
+        mailbox_status.uid_validity == sync_state.uid_validity
+        and mailbox_status.uid_next == sync_state.uid_next
+        and mailbox_status.messages == sync_state.message_count
+        and mailbox_status.highest_modseq == sync_state.highest_modseq
+    )
+
+def messages_expunged(sync_state: MailboxSyncState, mailbox_status: Optional[MailboxStatus]) -> bool:
+    """Whether STATUS shows fewer messages than there would be if none had been expunged"""
+    if mailbox_status is None or None in (
+        mailbox_status.messages, mailbox_status.uid_next, sync_state.message_count, sync_state.uid_next
+    ):
+        return False
+    arrived = mailbox_status.uid_next - sync_state.uid_next
+    return mailbox_status.messages < sync_state.message_count + arrived
+
+async def apply_flag_changes(db: AsyncSession, email_account_id: str, folder: str, fetched: List[FetchedMessage]) -> int:
+    """Store the read state the server reports for already synced messages"""
+    changes = [
+        {"b_uid": message.uid, "b_is_read": is_seen(message.meta)}
+        for message in fetched
+        if parse_fetch_flags(message.meta) is not None
+    ]
+    if not changes:
+        return 0
     
-    # Check for updates/notifications
-    update_terms = ['update', 'notification', 'confirm', 'verify', 'security', '更新', '通知']
-    if any(term in subject_lower for term in update_terms):
-        return "updates"
+    emails_table = Email.__table__
+    query = update(emails_table).where(
+        emails_table.c.email_account_id == email_account_id,
+        emails_table.c.folder == folder,
+        emails_table.c.uid == bindparam("b_uid")
+    ).values(is_read=bindparam("b_is_read"))
+    await db.execute(query, changes)
+    await db.commit()
+    return len(changes)
+
+async def relink_stored_emails(db: AsyncSession, email_account_id: str, folder: str, uids: Dict[str, int]):
+    """
+    Give stored emails without a UID, e.g. after a UIDVALIDITY change, the UIDs
+    their Message-IDs were found at in folder; not committed
+    """
+    if not uids:
+        return
+    emails_table = Email.__table__
+    query = update(emails_table).where(
+        emails_table.c.email_account_id == email_account_id,
+        emails_table.c.message_id == bindparam("b_message_id"),
+        emails_table.c.uid.is_(None)
+    ).values(uid=bindparam("b_uid"), folder=folder)
+    await db.execute(query, [{"b_message_id": message_id, "b_uid": uid} for message_id, uid in uids.items()])
+
+async def delete_expunged_emails(db: AsyncSession, email_account_id: str, folder: str, uids: List[int]) -> int:
+    """Delete the stored emails of messages expunged from a folder, with their attachments"""
+    removed = 0
+    for chunk in chunked(sorted(set(uids)), 500):
+        in_chunk = (Email.email_account_id == email_account_id, Email.folder == folder, Email.uid.in_(chunk))
+        email_ids = select(Email.id).where(*in_chunk)
+        
+        query = select(Attachment.file_path, Attachment.content_hash).where(Attachment.email_id.in_(email_ids))
+        attachment_files = (await db.execute(query)).all()
+        await db.execute(delete(Attachment).where(Attachment.email_id.in_(email_ids)))
+        result = await db.execute(delete(Email).where(*in_chunk))
+        await db.commit()
+        
+        removed += result.rowcount
+        if attachment_files:
+            await release_attachment_files(db, attachment_files)
+    return removed
+
+async def sync_stored_messages(
+    db: AsyncSession,
+    client: AsyncIMAPClient,
+    email_account_id: str,
+    folder: str,
+    sync_state: MailboxSyncState,
+    mailbox_status: Optional[MailboxStatus],
+    max_uid: int
+) -> Optional[int]:
+    """
+    Bring the read state and deletions of messages up to max_uid in line with
+    the selected folder, and return the HIGHESTMODSEQ they are now synced to
+    
+    With CONDSTORE only the flags changed since the stored HIGHESTMODSEQ are
+    fetched, and with QRESYNC the UIDs expunged since then come with them.
+    Without QRESYNC, expunges are looked for with a UID SEARCH, but only when
+    the message count from STATUS or SELECT shows that some happened.
+    """
+    highest_modseq = mailbox_status.highest_modseq if mailbox_status else None
+    synced_modseq = sync_state.highest_modseq
+    expunged: List[int] = []
     
-    # Check for potential spam
-    spam_terms = ['urgent', 'winner', 'won', 'prize', 'lottery', 'million', 'bitcoin', 'invest']
-    if any(term in subject_lower for term in spam_terms):
-        return "spam"
+    if client.supports("CONDSTORE") and highest_modseq is not None and highest_modseq != synced_modseq:
+        # Without a stored HIGHESTMODSEQ every flag is fetched once to start from
+        with observe_phase("flags"):
+            result = await client.fetch_flags(max_uid, synced_modseq)
+        if result is None:
+            logger.warning(f"Failed to fetch flags for {client.email_addr} {folder}")
+        else:
+            changed, expunged = result
+            updated = await apply_flag_changes(db, email_account_id, folder, changed)
+            logger.info(f"Updated flags of {updated} emails for {client.email_addr} {folder}")
+            synced_modseq = highest_modseq
     
-    # Check for important emails
-    important_terms = ['important', 'urgent', 'attention', 'required', 'action', '重要', '紧急']
-    if any(term in subject_lower for term in important_terms):
-        return "important"
+    if not client.supports("QRESYNC") and messages_expunged(sync_state, mailbox_status):
+        with observe_phase("search"):
+            present = await client.search_new_uids(0)
+        if present is not None:
+            query = select(Email.uid).where(
+                Email.email_account_id == email_account_id,
+                Email.folder == folder,
+                Email.uid <= max_uid
+            )
+            stored = set((await db.execute(query)).scalars().all())
+            expunged = list(stored - set(present))
     
-    # Default category
-    return "inbox"
+    if expunged:
+        removed = await delete_expunged_emails(db, email_account_id, folder, expunged)
+        logger.info(f"Removed {removed} emails expunged from {client.email_addr} {folder}")
+    return synced_modseq
 
-async def connect_imap(email_addr: str, access_token: str, email_account_id: str, user_id: str):
-    """Connect to IMAP server and fetch emails"""
+async def connect_imap(email_addr: str, access_token: str, email_account_id: str, user_id: str, folder: str = "INBOX") -> Optional[int]:
+    """Connect to IMAP server and fetch emails added since the last sync; returns the new email count, None on failure"""
     try:
-        # 在函数内部导入而不是在模块顶部
-        from app.main import manager
+        with observe_phase("sync"):
+            try:
+                with observe_phase("imap_connect"):
+                    client = await AsyncIMAPClient.connect(email_addr, access_token)
+            except Exception:
+                # A rejected token must not be reused on the next attempt
+                token_cache.invalidate(email_account_id)
+                raise
+            
+            try:
+                new_emails = await sync_folder(client, email_account_id, user_id, folder)
+            finally:
+                # Close the connection
+                logger.info(f"Closing connection for {email_addr}")
+                await client.logout()
         
-        logger.info(f"Connecting to IMAP server for {email_addr}")
+        if new_emails is None:
+            SYNC_RUNS.labels("error").inc()
+            return None
+        SYNC_RUNS.labels("ok").inc()
+        sync_lag.record_success(email_account_id)
+        return new_emails
+    except Exception as e:
+        SYNC_RUNS.labels("error").inc()
+        logger.error(f"Error in IMAP connection for {email_addr}: {str(e)}")
+        # Don't raise, just log the error
+
+async def sync_folder(client: AsyncIMAPClient, email_account_id: str, user_id: str, folder: str = "INBOX") -> Optional[int]:
+    """
+    Fetch messages added to a folder since its last checkpoint and return how
+    many new emails were stored, or None if the sync did not complete
+    
+    Syncs run as jobs, which never run twice at once for an account (see
+    app.email.jobs), so a folder is only synced by one caller at a time.
+    
+    The sync runs as fetch -> parse -> persist -> notify stages joined by queues
+    of SYNC_PIPELINE_DEPTH batches, so memory use follows the batch size rather
+    than the mailbox size and notifications go out as each batch is committed.
+    
+    Messages are synced newest first. After each committed batch the range
+    stored so far is saved as the resume range of the checkpoint, so a sync
+    that dies part way resumes below it instead of fetching everything again.
+    """
+    email_addr = client.email_addr
+    
+    # STATUS must not be used on the selected folder, where SELECT's counters stand in for it
+    mailbox_status = None
+    if client.selected_folder != folder:
+        try:
+            with observe_phase("status"):
+                mailbox_status = await client.status(folder)
+        except Exception as e:
+            logger.warning(f"STATUS {folder} failed for {email_addr}: {str(e)}")
+    
+    async with AsyncSessionLocal() as db:
+        sync_state = await get_sync_state(db, email_account_id, folder)
         
-        # Connect to server
-        mail = imaplib.IMAP4_SSL('outlook.office365.com')
+        # One round-trip instead of select, search and fetch for an unchanged folder
+        if folder_unchanged(sync_state, mailbox_status):
+            logger.info(f"No changes in {email_addr} {folder}, skipping sync")
+            await db.execute(
+                update(EmailAccount).where(EmailAccount.id == email_account_id).values(last_sync=datetime.now())
+            )
+            await db.commit()
+            return 0
         
-        # Authenticate
-        auth_string = generate_auth_string(email_addr, access_token)
-        logger.info(f"Authenticating {email_addr} with OAuth2")
+        # Read-only, so fetching a message body does not mark it as read on the server
+        with observe_phase("select"):
+            uid_validity = await client.select(folder, readonly=True)
+        # Without STATUS, expunges are checked and counters saved with SELECT's
+        if mailbox_status is None:
+            mailbox_status = client.selected_status
         
-        try:
-            auth_result = mail.authenticate('XOAUTH2', lambda x: auth_string)
-            logger.info(f"Authentication result: {auth_result}")
-        except Exception as auth_err:
-            logger.error(f"Authentication error for {email_addr}: {str(auth_err)}")
-            raise
+        # Load the checkpoint; a new UIDVALIDITY invalidates every stored UID
+        if uid_validity is None or sync_state.uid_validity != uid_validity:
+            if sync_state.last_uid:
+                logger.info(f"UIDVALIDITY changed for {email_addr} {folder}, running full resync")
+            # The stored UIDs may now name other messages, so flag changes and
+            # expunges must not match them; the resync sets them again
+            await db.execute(
+                update(Email).where(Email.email_account_id == email_account_id, Email.folder == folder).values(uid=None)
+            )
+            sync_state.uid_validity = uid_validity
+            sync_state.last_uid = 0
+            sync_state.resume_low_uid = None
+            sync_state.resume_high_uid = None
+            sync_state.highest_modseq = None
+            sync_state.parse_failed_uid = None
+            sync_state.parse_failures = 0
+        last_uid = sync_state.last_uid or 0
+        resume_low, resume_high = sync_state.resume_low_uid, sync_state.resume_high_uid
+        # A message that failed to parse in SYNC_PARSE_MAX_ATTEMPTS syncs is skipped,
+        # as it would otherwise stop every sync of the folder at the same place
+        parse_failed_uid, parse_failures = sync_state.parse_failed_uid, sync_state.parse_failures or 0
+        skip_uid = parse_failed_uid if parse_failures >= settings.SYNC_PARSE_MAX_ATTEMPTS else None
         
-        # Select inbox
-        logger.info(f"Selecting INBOX for {email_addr}")
-        select_result = mail.select("INBOX")
-        logger.info(f"Select result: {select_result}")
+        # A folder synced from scratch gets its flags with the messages
+        synced_modseq = mailbox_status.highest_modseq if mailbox_status else None
+        stored_top_uid = max(last_uid, resume_high or 0)
+        if stored_top_uid:
+            synced_modseq = await sync_stored_messages(
+                db, client, email_account_id, folder, sync_state, mailbox_status, stored_top_uid
+            )
         
-        # Get all emails
-        logger.info(f"Searching messages for {email_addr}")
-        status, messages = mail.search(None, 'ALL')
-        if status != 'OK':
-            logger.error(f"Failed to search emails for {email_addr}: {status}")
+        # Get emails added since the last synced UID
+        logger.info(f"Searching messages after UID {last_uid} for {email_addr}")
+        with observe_phase("search"):
+            uids = await client.search_new_uids(last_uid)
+        if uids is None:
+            logger.error(f"Failed to search emails for {email_addr}")
             return
         
-        message_ids = messages[0].split()
-        logger.info(f"Found {len(message_ids)} messages in {email_addr}")
+        # Top of the range this sync covers once it finishes
+        top_uid = max(uids + [resume_high or 0])
+        if resume_high is not None:
+            # Skip what an interrupted sync already stored
+            uids = [uid for uid in uids if not resume_low <= uid <= resume_high]
+            logger.info(f"Resuming sync of {email_addr} {folder}, UIDs {resume_low}-{resume_high} already stored")
         
-        # Process each email
-        async with AsyncSessionLocal() as db:
-            # Update last_sync time
-            query = select(EmailAccount).where(EmailAccount.id == email_account_id)
-            result = await db.execute(query)
-            email_account = result.scalars().first()
-            if email_account:
-                email_account.last_sync = datetime.now()
-                await db.commit()
-            
-            # Process emails in reverse order (newest first)
-            new_emails = []
-            for num in reversed(message_ids):
-                status, data = mail.fetch(num, '(RFC822)')
-                if status != 'OK':
-                    logger.warning(f"Failed to fetch message {num} for {email_addr}: {status}")
-                    continue
+        logger.info(f"Found {len(uids)} new messages in {email_addr}")
+        
+        # Update last_sync time
+        query = select(EmailAccount).where(EmailAccount.id == email_account_id)
+        result = await db.execute(query)
+        email_account = result.scalars().first()
+        if email_account:
+            email_account.last_sync = datetime.now()
+        await db.commit()
+        sync_state_id = sync_state.id
+        
+        async def save_checkpoint(**values):
+            # A plain UPDATE, as a failed batch rolls back and expires sync_state
+            await db.execute(update(MailboxSyncState).where(MailboxSyncState.id == sync_state_id).values(**values))
+            await db.commit()
+        
+        # In header-only mode bodies and attachments are fetched on first read
+        headers_only = settings.IMAP_SYNC_MODE == "headers"
+        fetch_items = HEADER_FETCH_ITEMS if headers_only else '(UID RFC822.SIZE FLAGS RFC822)'
+        
+        fetched_queue = asyncio.Queue(maxsize=settings.SYNC_PIPELINE_DEPTH)
+        parsed_queue = asyncio.Queue(maxsize=settings.SYNC_PIPELINE_DEPTH)
+        notify_queue = asyncio.Queue(maxsize=settings.SYNC_PIPELINE_DEPTH)
+        new_email_count = 0
+        # Set once a batch could not be synced; the checkpoint then stays above it
+        incomplete = False
+        # UID of the message that failed to parse where the sync stopped
+        unparsed_uid = None
+        
+        async def fetch_stage():
+            nonlocal incomplete
+            # Newest first, one FETCH per batch of UIDs
+            for batch in chunked(list(reversed(uids)), settings.IMAP_FETCH_BATCH_SIZE):
+                if incomplete:
+                    # The parse stage stopped at a message it could not process
+                    break
+                with observe_phase("fetch"):
+                    fetched = await client.fetch_uid_batch(batch, fetch_items)
+                if fetched is None:
+                    # Later batches would move the checkpoint past this one
+                    SYNC_ERRORS.labels("fetch", "FetchFailed").inc()
+                    logger.warning(f"Failed to fetch UIDs {batch[-1]}-{batch[0]} for {email_addr}")
+                    incomplete = True
+                    break
+                SYNC_MESSAGES.labels("fetched").inc(len(fetched))
+                SYNC_FETCHED_BYTES.inc(sum(len(literal) for message in fetched for literal in message.literals))
+                # Batches carry their lowest UID for the checkpoint
+                await fetched_queue.put((batch[-1], fetched))
+            await fetched_queue.put(STOP)
+        
+        async def parse_stage():
+            nonlocal incomplete, unparsed_uid
+            # Duplicate lookups use their own session while the persist stage writes
+            async with AsyncSessionLocal() as lookup_db:
+                rule_index = await user_rule_cache.get_index(lookup_db, user_id)
                 
-                raw_email = data[0][1]
-                msg = email_module.message_from_bytes(raw_email)
+                stopped = False
+                while (item := await fetched_queue.get()) is not STOP:
+                    if stopped:
+                        # Drop what was fetched before the fetch stage saw the failure
+                        continue
+                    batch_low, fetched = item
+                    # The header literal comes last, after any literal inside BODYSTRUCTURE.
+                    # Only the header block is read here, so duplicates are never fully parsed
+                    candidates = [
+                        (message, extract_message_id(message.literals[-1]))
+                        for message in sorted(fetched, key=lambda m: m.uid, reverse=True)
+                        if message.literals
+                    ]
+                    
+                    # One query for the whole batch instead of a lookup per message
+                    stored = await find_existing_message_ids(
+                        lookup_db, email_account_id, (message_id for _, message_id in candidates)
+                    )
+                    seen = set(stored)
+                    
+                    new_messages = []
+                    # UIDs of already stored messages, which lost theirs if UIDVALIDITY changed
+                    stored_uids = {}
+                    for message, message_id in candidates:
+                        if message_id:
+                            if message_id in seen:
+                                if message_id in stored:
+                                    stored_uids.setdefault(message_id, message.uid)
+                                continue
+                            seen.add(message_id)
+                        new_messages.append(message)
+                    
+                    # Parse and decode in worker processes
+                    with observe_phase("parse"):
+                        parsed_messages = await parse_raw_messages(
+                            [(message.literals[-1], generate_uuid()) for message in new_messages],
+                            headers_only
+                        )
+                    
+                    # A missing literal may come back on the next attempt
+                    failed_uids = [message.uid for message in fetched if not message.literals]
+                    unparsed_uids = []
+                    parsed_pairs = []
+                    for message, parsed in zip(new_messages, parsed_messages):
+                        if parsed is None:
+                            if message.uid == skip_uid:
+                                logger.error(f"Skipping email UID {message.uid} for {email_addr}, it failed to parse {parse_failures} times")
+                                continue
+                            SYNC_ERRORS.labels("parse", "ParseFailed").inc()
+                            logger.error(f"Error processing email UID {message.uid} for {email_addr}")
+                            unparsed_uids.append(message.uid)
+                            continue
+                        parsed_pairs.append((message, parsed))
+                    
+                    if failed_uids or unparsed_uids:
+                        # The checkpoint may only pass stored emails and duplicates, so the
+                        # batch is cut off above the newest failed message and the sync ends
+                        failed_uid = max(failed_uids + unparsed_uids)
+                        if failed_uid in unparsed_uids:
+                            unparsed_uid = failed_uid
+                        parsed_pairs = [(message, parsed) for message, parsed in parsed_pairs if message.uid > failed_uid]
+                        batch_low = failed_uid + 1
+                        incomplete = stopped = True
+                    SYNC_MESSAGES.labels("parsed").inc(len(parsed_pairs))
+                    
+                    # Categorize the whole batch at once; the user's own rules take
+                    # precedence over the built-in categories
+                    with observe_phase("categorize"):
+                        categories = categorize_many(parsed._asdict() for _, parsed in parsed_pairs)
+                        categories = [
+                            rule_index.categorize(parsed.sender, parsed.subject, parsed.headers) or category
+                            for (_, parsed), category in zip(parsed_pairs, categories)
+                        ]
+                    
+                    records = []
+                    for (message, parsed), category in zip(parsed_pairs, categories):
+                        record = build_email_record(
+                            parsed,
+                            email_account_id,
+                            uid=message.uid,
+                            folder=folder,
+                            size=parse_fetch_size(message.meta),
+                            headers_only=headers_only,
+                            has_attachments=bodystructure_has_attachments(message.meta) if headers_only else None,
+                            category=category,
+                            is_read=is_seen(message.meta)
+                        )
+                        records.append((record, parsed.attachments))
+                    await parsed_queue.put((batch_low, records, stored_uids))
+            await parsed_queue.put(STOP)
+        
+        async def persist_stage():
+            # One insert transaction per SYNC_DB_BATCH_SIZE emails; rows repeated
+            # across batches are dropped by the unique index
+            writer = EmailBatchWriter(db, settings.SYNC_DB_BATCH_SIZE)
+            
+            async def forward(written: List[Dict[str, Any]]):
+                # Only what the notification needs is kept past the commit
+                if written:
+                    await notify_queue.put([
+                        {
+                            "id": email["id"],
+                            "subject": email["subject"],
+                            "sender": email["sender"],
+                            "date": email["date_received"].isoformat()
+                        }
+                        for email in written
+                    ])
+            
+            async def checkpoint(low: int):
+                # Everything from low up to top_uid is stored. While the UIDs above an
+                # earlier resume range are synced the two ranges are apart, so the
+                # earlier one is kept until this sync reaches it
+                if resume_low is None or low <= resume_low:
+                    await save_checkpoint(resume_low_uid=low, resume_high_uid=top_uid)
+            
+            # Lowest UID of the batches added to the writer but not yet committed
+            uncommitted_low = None
+            while (item := await parsed_queue.get()) is not STOP:
+                batch_low, records, stored_uids = item
+                # Committed with the batch's emails or its checkpoint
+                await relink_stored_emails(db, email_account_id, folder, stored_uids)
+                for record, attachments in records:
+                    if record["message_id"] and writer.is_pending(record["message_id"]):
+                        continue
+                    await forward(await writer.add(record, attachments))
+                    if uncommitted_low is not None and not writer.pending:
+                        # The writer flushed, committing every earlier batch
+                        await checkpoint(uncommitted_low)
+                        uncommitted_low = None
                 
-                email = await process_email_message(msg, email_account_id, db)
-                if email:
-                    new_emails.append(email)
+                if writer.pending:
+                    uncommitted_low = batch_low
+                else:
+                    await checkpoint(batch_low)
             
-            # Notify via WebSocket if there are new emails
-            if new_emails:
-                logger.info(f"Processed {len(new_emails)} new emails for {email_addr}")
-                for email in new_emails:
-                    notification = {
-                        "type": "new_email",
-                        "data": {
-                            "id": email.id,
-                            "subject": email.subject,
-                            "sender": email.sender,
-                            "date": email.date_received.isoformat()
+            # Write out the last partial batch
+            await forward(await writer.flush())
+            if uncommitted_low is not None:
+                await checkpoint(uncommitted_low)
+            await notify_queue.put(STOP)
+        
+        async def notify_stage():
+            nonlocal new_email_count
+            # Notify via WebSocket as soon as each batch is committed; the API process
+            # holding the user's WebSockets relays the queued messages
+            while (summaries := await notify_queue.get()) is not STOP:
+                new_email_count += len(summaries)
+                with observe_phase("notify"):
+                    notifications = [
+                        {
+                            "type": "new_email",
+                            "data": summary
                         }
-                    }
-                    await manager.send_personal_message(notification, user_id)
-            else:
-                logger.info(f"No new emails found for {email_addr}")
+                        for summary in summaries
+                    ]
+                    # The batch is committed, so its notifications go out even if
+                    # another stage fails meanwhile
+                    await publish_notifications(user_id, notifications)
+                SYNC_MESSAGES.labels("notified").inc(len(summaries))
         
-        # Close the connection
-        logger.info(f"Closing connection for {email_addr}")
-        mail.close()
-        mail.logout()
+        await run_pipeline(fetch_stage(), parse_stage(), persist_stage(), notify_stage())
         
-    except Exception as e:
-        logger.error(f"Error in IMAP connection for {email_addr}: {str(e)}")
-        # Don't raise, just log the error
+        if incomplete:
+            if unparsed_uid is not None:
+                failures = parse_failures + 1 if unparsed_uid == parse_failed_uid else 1
+                await save_checkpoint(parse_failed_uid=unparsed_uid, parse_failures=failures)
+            # The resume range covers what was stored; the next sync retries the rest
+            logger.warning(f"Sync of {email_addr} {folder} stopped early after {new_email_count} new emails")
+            return None
+        
+        # Advance the checkpoint once the whole range has been processed. The
+        # counters are the ones from before the sync, so anything that arrived
+        # during it shows up as a change next time
+        checkpoint_values = {
+            "uid_next": mailbox_status.uid_next if mailbox_status else None,
+            "message_count": mailbox_status.messages if mailbox_status else None,
+            "highest_modseq": synced_modseq,
+            "parse_failed_uid": None,
+            "parse_failures": 0
+        }
+        if top_uid:
+            checkpoint_values.update(last_uid=top_uid, resume_low_uid=None, resume_high_uid=None)
+        await save_checkpoint(**checkpoint_values)
+        
+        if new_email_count:
+            logger.info(f"Processed {new_email_count} new emails for {email_addr}")
+        else:
+            logger.info(f"No new emails found for {email_addr}")
+        return new_email_count
+
+async def open_account_client(account_id: str) -> Optional[AsyncIMAPClient]:
+    """Open an authenticated IMAP session for an account"""
+    async with AsyncSessionLocal() as db:
+        query = select(EmailAccount).where(EmailAccount.id == account_id)
+        result = await db.execute(query)
+        account = result.scalars().first()
+        if not account:
+            logger.error(f"Account {account_id} not found")
+            return None
+        access_token = await token_cache.get_token(account, db)
+        email_addr = account.email_address
+    
+    try:
+        return await AsyncIMAPClient.connect(email_addr, access_token)
+    except Exception:
+        token_cache.invalidate(account_id)
+        raise
+
+async def update_sync_schedule(
+    db: AsyncSession,
+    account: EmailAccount,
+    new_emails: Optional[int],
+    previous_sync: Optional[datetime]
+):
+    """
+    Record the outcome of a sync and choose when the account is polled next
+    
+    new_emails is None when the sync failed; the account then keeps its interval.
+    The first sync of an account imports its backlog and does not count toward
+    the arrival rate.
+    """
+    now = datetime.now()
+    if new_emails is not None:
+        if previous_sync is not None:
+            elapsed = (now - previous_sync.replace(tzinfo=None)).total_seconds()
+            account.arrival_rate = update_arrival_rate(
+                account.arrival_rate or 0.0, new_emails, elapsed, settings.SYNC_RATE_WINDOW_SECONDS
+            )
+            interval = next_sync_interval(
+                account.arrival_rate, settings.SYNC_MIN_INTERVAL_SECONDS, settings.SYNC_MAX_INTERVAL_SECONDS
+            )
+        else:
+            interval = settings.SYNC_INTERVAL_SECONDS
+        if new_emails:
+            account.last_change_at = now
+    else:
+        interval = account.sync_interval or settings.SYNC_INTERVAL_SECONDS
+    
+    # Users looking at their mail get fresher results
+    if await is_user_connected(db, account.user_id):
+        interval = min(interval, settings.SYNC_ACTIVE_USER_INTERVAL_SECONDS)
+    
+    account.sync_interval = int(interval)
+    account.next_sync_at = now + timedelta(seconds=interval)
+    await db.commit()
+
+async def bump_user_sync(user_id: str):
+    """Queue high priority syncs for every account of a user"""
+    async with AsyncSessionLocal() as db:
+        query = select(EmailAccount.id).where(EmailAccount.user_id == user_id)
+        result = await db.execute(query)
+        for account_id in result.scalars().all():
+            await enqueue_sync(db, account_id, user_id, PRIORITY_HIGH)
 
-async def fetch_emails_for_account(account_id: str, user_id: str):
-    """Fetch emails for a specific account"""
+async def fetch_emails_for_account(account_id: str, user_id: str) -> Optional[int]:
+    """Fetch emails for a specific account; returns the new email count, None if the sync failed"""
     try:
         logger.info(f"Starting email fetch for account {account_id}")
         async with AsyncSessionLocal() as db:
@@ -351,55 +908,85 @@ async def fetch_emails_for_account(account_id: str, user_id: str):
             account = result.scalars().first()
             
             if not account:
+                # Deleted since the sync was requested; nothing to retry
                 logger.error(f"Account {account_id} not found")
-                return
+                return 0
             
             logger.info(f"Fetching emails for {account.email_address}")
+            previous_sync = account.last_sync
             
             try:
                 # Get access token
-                access_token = await get_access_token(account.client_id, account.refresh_token)
+                access_token = await token_cache.get_token(account, db)
                 logger.info(f"Successfully retrieved access token for {account.email_address}")
                 
                 # Fetch emails
-                await connect_imap(account.email_address, access_token, account.id, user_id)
+                new_emails = await connect_imap(account.email_address, access_token, account.id, user_id)
                 logger.info(f"Email fetch completed for {account.email_address}")
+                await update_sync_schedule(db, account, new_emails, previous_sync)
+                return new_emails
             except Exception as token_error:
                 logger.error(f"Failed to get access token for {account.email_address}: {str(token_error)}")
                 # Update last_sync time with error status
                 account.last_sync = datetime.now()
-                await db.commit()
+                await update_sync_schedule(db, account, None, previous_sync)
                 # Re-raise to be caught by outer exception handler
                 raise
-            
+    
     except Exception as e:
         logger.error(f"Error fetching emails for account {account_id}: {str(e)}")
         # Log stack trace for debugging
         import traceback
         logger.error(traceback.format_exc())
 
-async def background_email_sync():
-    """Background task to sync emails for all accounts periodically"""
-    try:
-        while True:
+async def schedule_due_accounts(membership: Optional[ShardMembership] = None):
+    """
+    Queue sync jobs for accounts whose polling interval has elapsed
+    
+    Accounts are polled on their own adaptive interval (see update_sync_schedule).
+    Queued accounts are pushed back by SYNC_MAX_INTERVAL_SECONDS so they are not
+    queued again before their sync reschedules them. Runs in the sync worker,
+    which only schedules the accounts in the shards of its membership.
+    """
+    while True:
+        try:
+            now = datetime.now()
+            owned = []
+            if membership is not None:
+                owned.append(account_shard(EmailAccount.id).in_(membership.shards))
+            
             async with AsyncSessionLocal() as db:
-                # Get all active accounts
-                query = select(EmailAccount)
+                # Accounts that are due, or have never been scheduled
+                query = select(EmailAccount.id, EmailAccount.user_id).where(
+                    or_(EmailAccount.next_sync_at.is_(None), EmailAccount.next_sync_at <= now), *owned
+                ).order_by(EmailAccount.next_sync_at)
                 result = await db.execute(query)
-                accounts = result.scalars().all()
+                due_accounts = result.all()
+                connected = await connected_users(db, {user_id for _, user_id in due_accounts})
                 
-                for account in accounts:
-                    try:
-                        await fetch_emails_for_account(account.id, account.user_id)
-                    except Exception as e:
-                        logger.error(f"Error syncing account {account.email_address}: {str(e)}")
-                    
-                    # Sleep briefly between accounts to avoid hammering the server
-                    await asyncio.sleep(5)
+                for account_id, user_id in due_accounts:
+                    priority = PRIORITY_HIGH if user_id in connected else PRIORITY_NORMAL
+                    await enqueue_sync(db, account_id, user_id, priority)
+                
+                if due_accounts:
+                    await db.execute(
+                        update(EmailAccount).where(
+                            EmailAccount.id.in_([account_id for account_id, _ in due_accounts])
+                        ).values(next_sync_at=now + timedelta(seconds=settings.SYNC_MAX_INTERVAL_SECONDS))
+                    )
+                    await db.commit()
+                    logger.info(f"Queued {len(due_accounts)} due accounts for sync")
+                
+                query = select(func.min(EmailAccount.next_sync_at)).where(EmailAccount.next_sync_at > now, *owned)
+                next_due = (await db.execute(query)).scalar()
             
-            # Sleep for 5 minutes before checking again
-            await asyncio.sleep(300)
-    except Exception as e:
-        logger.error(f"Error in background sync: {str(e)}")
-        # Restart the task
-        asyncio.create_task(background_email_sync()) 
\ No newline at end of file
+            # Sleep until the next account is due; new accounts are picked up within the minimum interval
+            timeout = settings.SYNC_MIN_INTERVAL_SECONDS
+            if next_due is not None:
+                timeout = min(timeout, (next_due.replace(tzinfo=None) - datetime.now()).total_seconds())
+            await asyncio.sleep(max(1.0, timeout))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error scheduling account syncs: {str(e)}")
+            await asyncio.sleep(settings.SYNC_MIN_INTERVAL_SECONDS)
@@ -0,0 +1,90 @@
+"""
+Sharding of accounts across sync workers
+
+Accounts fall into 256 shards by the first two hex digits of their UUID. Every
+worker registers in the sync_nodes table and heartbeats there; a worker whose
+heartbeat is older than SYNC_NODE_TTL_SECONDS is considered dead. Shards are
+assigned to the live workers by rendezvous hashing, which every worker computes
+for itself from the same list, so no coordinator is needed. When a worker joins
+or dies only the shards it gains or loses move.
+
+Ownership decides which worker schedules an account and claims its jobs. The
+job leases still guarantee that an account is never synced twice at once while
+workers disagree about ownership, e.g. during a rebalance.
+"""
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Sequence
+
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.models import SyncNode
+from app.email.writer import insert_ignoring_duplicates
+
+logger = logging.getLogger(__name__)
+
+SHARDS = [f"{shard:02x}" for shard in range(256)]
+
+def account_shard(column):
+    """SQL expression for the shard of an account ID column"""
+    return func.substr(column, 1, 2)
+
+def rendezvous_weight(node: str, shard: str) -> int:
+    # crc32 mixes similar node IDs (host:pid) too poorly to spread shards evenly
+    digest = hashlib.blake2b(f"{node}/{shard}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+def assign_shards(nodes: Sequence[str]) -> Dict[str, List[str]]:
+    """Give each shard to the node with the highest weight for it"""
+    assignment: Dict[str, List[str]] = {node: [] for node in nodes}
+    if not nodes:
+        return assignment
+    for shard in SHARDS:
+        owner = max(nodes, key=lambda node: rendezvous_weight(node, shard))
+        assignment[owner].append(shard)
+    return assignment
+
+class ShardMembership:
+    """A worker's registration in sync_nodes and the shards it currently owns"""
+    
+    def __init__(self, node_id: str):
+        self.node_id = node_id
+        self.nodes: List[str] = []
+        self.shards: List[str] = []
+    
+    async def heartbeat(self, db: AsyncSession):
+        """Renew this node's lease and recompute shard ownership from the live nodes"""
+        now = datetime.now()
+        result = await db.execute(
+            update(SyncNode).where(SyncNode.id == self.node_id).values(heartbeat_at=now)
+        )
+        if result.rowcount == 0:
+            await db.execute(
+                insert_ignoring_duplicates(db, SyncNode),
+                [{"id": self.node_id, "started_at": now, "heartbeat_at": now}]
+            )
+        
+        # Dead nodes are removed by whichever node notices first
+        expired_before = now - timedelta(seconds=settings.SYNC_NODE_TTL_SECONDS)
+        await db.execute(delete(SyncNode).where(SyncNode.heartbeat_at < expired_before))
+        await db.commit()
+        
+        result = await db.execute(select(SyncNode.id).order_by(SyncNode.id))
+        nodes = list(result.scalars().all())
+        if self.node_id not in nodes:
+            nodes.append(self.node_id)
+        
+        if nodes != self.nodes:
+            self.shards = assign_shards(nodes)[self.node_id]
+            logger.info(f"Sync nodes changed to {len(nodes)}, node {self.node_id} now owns {len(self.shards)} shards")
+            self.nodes = nodes
+    
+    async def leave(self, db: AsyncSession):
+        """Deregister so the other nodes take over this node's shards right away"""
+        await db.execute(delete(SyncNode).where(SyncNode.id == self.node_id))
+        await db.commit()
+        self.nodes = []
+        self.shards = []
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import EmailAccount
+
+logger = logging.getLogger(__name__)
+
+class CachedToken(NamedTuple):
+    access_token: str
+    expires_at: float  # Unix timestamp
+
+def to_timestamp(value: Optional[datetime]) -> Optional[float]:
+    """Convert a stored expiry to a Unix timestamp, treating naive values as UTC"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+class TokenCache:
+    """
+    Per-account OAuth access token cache
+    
+    Tokens are reused until refresh_margin seconds before they expire. Only one
+    refresh per account runs at a time; concurrent callers wait for it and share
+    the result. Tokens and rotated refresh tokens are written back to the account
+    row when persist is enabled, so restarts do not force a refresh.
+    """
+    
+    def __init__(
+        self,
+        refresh_func: Callable[[str, str], Awaitable[Dict[str, Any]]],
+        refresh_margin: int = 300,
+        persist: bool = True
+    ):
+        self.refresh_func = refresh_func
+        self.refresh_margin = refresh_margin
+        self.persist = persist
+        self.tokens: Dict[str, CachedToken] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        # Tokens the server rejected, which may still be stored on the account row
+        self.rejected: Dict[str, str] = {}
+    
+    def _is_fresh(self, cached: Optional[CachedToken]) -> bool:
+        return cached is not None and cached.expires_at - self.refresh_margin > time.time()
+    
+    def _load_persisted(self, account: EmailAccount) -> Optional[CachedToken]:
+        if not self.persist or not account.access_token:
+            return None
+        if self.rejected.get(account.id) == account.access_token:
+            return None
+        expires_at = to_timestamp(account.access_token_expires_at)
+        if expires_at is None:
+            return None
+        return CachedToken(account.access_token, expires_at)
+    
+    async def get_token(self, account: EmailAccount, db: AsyncSession) -> str:
+        """Return a valid access token for the account, refreshing it if needed"""
+        cached = self.tokens.get(account.id)
+        if self._is_fresh(cached):
+            return cached.access_token
+        
+        cached = self._load_persisted(account)
+        if self._is_fresh(cached):
+            self.tokens[account.id] = cached
+            return cached.access_token
+        
+        lock = self.locks.setdefault(account.id, asyncio.Lock())
+        async with lock:
+            # Another caller may have refreshed while we were waiting
+            cached = self.tokens.get(account.id)
+            if self._is_fresh(cached):
+                return cached.access_token
+            
+            payload = await self.refresh_func(account.client_id, account.refresh_token)
+            expires_in = int(payload.get('expires_in') or 3600)
+            cached = CachedToken(payload['access_token'], time.time() + expires_in)
+            self.tokens[account.id] = cached
+            self.rejected.pop(account.id, None)
+            
+            # The token endpoint may rotate the refresh token; the old one stops working
+            new_refresh_token = payload.get('refresh_token')
+            if new_refresh_token and new_refresh_token != account.refresh_token:
+                logger.info(f"Storing rotated refresh token for {account.email_address}")
+                account.refresh_token = new_refresh_token
+            
+            if self.persist:
+                account.access_token = cached.access_token
+                account.access_token_expires_at = datetime.fromtimestamp(cached.expires_at, timezone.utc)
+            
+            await db.commit()
+            return cached.access_token
+    
+    def invalidate(self, account_id: str):
+        """Forget the cached token, e.g. after the server rejected it, so the next call refreshes"""
+        cached = self.tokens.pop(account_id, None)
+        if cached is not None:
+            self.rejected[account_id] = cached.access_token
+    
+    def discard(self, account_id: str):
+        """Drop all state for a deleted account"""
+        self.tokens.pop(account_id, None)
+        self.locks.pop(account_id, None)
+        self.rejected.pop(account_id, None)
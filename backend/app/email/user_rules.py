@@ -0,0 +1,129 @@
+"""
+Per-user categorization rules
+
+A user's rules are compiled into a UserRuleIndex: exact senders and sender
+domains go into dicts, subject and header keywords into one FieldMatcher per
+field. Categorizing a message costs a few dict lookups plus one scan of each
+field, however many rules the user has.
+"""
+import logging
+import time
+from email.utils import parseaddr
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.db.models import CategoryRule
+from app.email.categorizer import FieldMatcher
+
+logger = logging.getLogger(__name__)
+
+def sender_address(sender: Optional[str]) -> str:
+    """Lowercase address part of a From header"""
+    return parseaddr(sender or "")[1].lower()
+
+def normalize_rule_value(rule_type: str, value: str) -> str:
+    value = value.strip().lower()
+    if rule_type == "domain":
+        value = value.lstrip("@.")
+    return value
+
+class UserRuleIndex:
+    """
+    Compiled rules of one user
+    
+    Rules are numbered in creation order. Exact sender rules win over domain
+    rules, then the most specific domain, then header and subject keywords, where
+    the oldest matching rule wins.
+    """
+    
+    def __init__(self, rules: Sequence[CategoryRule]):
+        self.categories: List[str] = []
+        self.senders: Dict[str, int] = {}
+        self.domains: Dict[str, int] = {}
+        subject_terms: Dict[str, Set[int]] = {}
+        header_terms: Dict[str, Dict[str, Set[int]]] = {}
+        
+        for rule in rules:
+            value = normalize_rule_value(rule.rule_type, rule.value or "")
+            if not value:
+                continue
+            position = len(self.categories)
+            self.categories.append(rule.category)
+            
+            if rule.rule_type == "sender":
+                self.senders.setdefault(value, position)
+            elif rule.rule_type == "domain":
+                self.domains.setdefault(value, position)
+            elif rule.rule_type == "subject":
+                subject_terms.setdefault(value, set()).add(position)
+            elif rule.rule_type == "header" and rule.header_name:
+                header_terms.setdefault(rule.header_name.strip().lower(), {}).setdefault(value, set()).add(position)
+        
+        self.subject = FieldMatcher(subject_terms) if subject_terms else None
+        self.headers = {name: FieldMatcher(terms) for name, terms in header_terms.items()}
+    
+    def __len__(self) -> int:
+        return len(self.categories)
+    
+    def categorize(self, sender: Optional[str], subject: Optional[str], headers: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """
+        Return the category of the first matching rule, or None if no rule matches
+        
+        Header rules are skipped when headers is None, as for stored emails.
+        """
+        if not self.categories:
+            return None
+        
+        address = sender_address(sender)
+        if address in self.senders:
+            return self.categories[self.senders[address]]
+        
+        # mail.example.com also matches rules for example.com
+        domain = address.rpartition("@")[2]
+        while domain:
+            if domain in self.domains:
+                return self.categories[self.domains[domain]]
+            domain = domain.partition(".")[2]
+        
+        found: Set[int] = set()
+        if headers:
+            for name, matcher in self.headers.items():
+                matcher.match(headers.get(name), found)
+        if self.subject:
+            self.subject.match(subject, found)
+        if found:
+            return self.categories[min(found)]
+        return None
+
+class UserRuleCache:
+    """
+    Compiled rule indexes by user ID
+    
+    Entries are dropped by invalidate when the user's rules change here, and
+    expire after ttl seconds so changes made in other processes are picked up.
+    """
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.entries: Dict[str, Tuple[UserRuleIndex, float]] = {}
+    
+    async def get_index(self, db: AsyncSession, user_id: str) -> UserRuleIndex:
+        entry = self.entries.get(user_id)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+        
+        query = select(CategoryRule).where(
+            CategoryRule.user_id == user_id
+        ).order_by(CategoryRule.created_at, CategoryRule.id)
+        result = await db.execute(query)
+        index = UserRuleIndex(result.scalars().all())
+        self.entries[user_id] = (index, time.monotonic())
+        return index
+    
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+user_rule_cache = UserRuleCache(settings.USER_RULES_CACHE_TTL_SECONDS)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Email, Attachment
+from app.email.attachment_store import content_path, remove_files
+from app.email.imap import chunked
+from app.email.metrics import SYNC_MESSAGES, observe_phase
+
+logger = logging.getLogger(__name__)
+
+# Unreferenced attachment files younger than this are left in place
+ATTACHMENT_RELEASE_GRACE_SECONDS = 600
+
+def insert_ignoring_duplicates(db: AsyncSession, table):
+    """INSERT that skips rows violating a unique constraint, where the dialect supports it"""
+    dialect = db.bind.dialect.name
+    if dialect == "sqlite":
+        return sqlite_insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql_insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+async def release_attachment_files(db: AsyncSession, rows: Iterable[Tuple[str, Optional[str]]]):
+    """
+    Delete attachment files no longer referenced by any attachment row
+    
+    rows are (file_path, content_hash) pairs of attachments that were deleted or
+    never inserted. Content-addressed files are only removed when no row shares
+    their hash and they were not written in the last few minutes, which keeps a
+    file that a concurrent sync is about to reference.
+    """
+    rows = list(rows)
+    hashes = {content_hash for _, content_hash in rows if content_hash}
+    
+    referenced = set()
+    for chunk in chunked(list(hashes), 500):
+        query = select(Attachment.content_hash).where(Attachment.content_hash.in_(chunk)).distinct()
+        result = await db.execute(query)
+        referenced.update(row[0] for row in result)
+    
+    # Files from before content addressing belong to a single row
+    legacy_paths = [file_path for file_path, content_hash in rows if not content_hash and file_path]
+    unreferenced_paths = [content_path(content_hash) for content_hash in hashes - referenced]
+    
+    await asyncio.to_thread(remove_files, legacy_paths)
+    await asyncio.to_thread(remove_files, unreferenced_paths, ATTACHMENT_RELEASE_GRACE_SECONDS)
+
+class EmailBatchWriter:
+    """
+    Accumulates synced emails and their attachments and writes them with bulk
+    inserts, one transaction per batch_size emails
+    
+    Rows carry client-generated IDs, so nothing has to be read back after the
+    insert. Emails that lose a race to the unique (account, Message-ID) index
+    are skipped together with their attachments.
+    """
+    
+    def __init__(self, db: AsyncSession, batch_size: int):
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self.emails: List[Dict[str, Any]] = []
+        self.attachments: List[Dict[str, Any]] = []
+        self.pending_message_ids: Set[str] = set()
+    
+    @staticmethod
+    def _file_refs(rows: List[Dict[str, Any]]) -> List[Tuple[str, Optional[str]]]:
+        return [(row["file_path"], row.get("content_hash")) for row in rows]
+    
+    @property
+    def pending(self) -> bool:
+        """Whether emails are waiting to be flushed"""
+        return bool(self.emails)
+    
+    def is_pending(self, message_id: str) -> bool:
+        """Check whether an email with this Message-ID is waiting to be flushed"""
+        return message_id in self.pending_message_ids
+    
+    async def add(self, email: Dict[str, Any], attachments: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Queue an email; returns the emails written if this filled the batch"""
+        self.emails.append(email)
+        self.attachments.extend(attachments)
+        if email.get("message_id"):
+            self.pending_message_ids.add(email["message_id"])
+        
+        if len(self.emails) >= self.batch_size:
+            return await self.flush()
+        return []
+    
+    async def flush(self) -> List[Dict[str, Any]]:
+        """
+        Insert all queued rows in one transaction and return the emails actually written
+        
+        A failed write is rolled back and re-raised, so the sync stops instead of
+        checkpointing past emails that were never stored.
+        """
+        if not self.emails:
+            return []
+        
+        emails, attachments = self.emails, self.attachments
+        self.emails, self.attachments = [], []
+        self.pending_message_ids.clear()
+        
+        try:
+            with observe_phase("db_write"):
+                result = await self.db.execute(
+                    insert_ignoring_duplicates(self.db, Email).returning(Email.id),
+                    emails
+                )
+                inserted_ids = set(result.scalars().all())
+                
+                attachment_rows = [row for row in attachments if row["email_id"] in inserted_ids]
+                if attachment_rows:
+                    await self.db.execute(insert(Attachment), attachment_rows)
+                
+                await self.db.commit()
+        except Exception as e:
+            logger.error(f"Error writing batch of {len(emails)} emails: {str(e)}")
+            await self.db.rollback()
+            await release_attachment_files(self.db, self._file_refs(attachments))
+            raise
+        
+        # Files written for emails that turned out to be duplicates may not be referenced
+        skipped = [row for row in attachments if row["email_id"] not in inserted_ids]
+        if skipped:
+            await release_attachment_files(self.db, self._file_refs(skipped))
+        
+        SYNC_MESSAGES.labels("stored").inc(len(inserted_ids))
+        return [email for email in emails if email["id"] in inserted_ids]
@@ -1,11 +1,15 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from starlette.websockets import WebSocket, WebSocketDisconnect
 import asyncio
 
 from app.core.config import settings
 from app.api.api_v1.api import api_router
 from app.db.init_db import init_db
+from app.db.session import AsyncSessionLocal
+from app.email.jobs import default_worker_id
+from app.email.notifications import mark_connected, mark_disconnected, relay_notifications
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -24,25 +28,30 @@ app.add_middleware(
 # Include API router
 app.include_router(api_router, prefix=settings.API_V1_STR)
 
+# Prometheus metrics, including the email sync metrics in app.email.metrics
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
         # Map user_id to list of connections
         self.active_connections: dict[str, list[WebSocket]] = {}
-
+    
     async def connect(self, websocket: WebSocket, user_id: str):
         await websocket.accept()
         if user_id not in self.active_connections:
             self.active_connections[user_id] = []
         self.active_connections[user_id].append(websocket)
-
+    
     def disconnect(self, websocket: WebSocket, user_id: str):
         if user_id in self.active_connections:
             if websocket in self.active_connections[user_id]:
                 self.active_connections[user_id].remove(websocket)
             if not self.active_connections[user_id]:
                 del self.active_connections[user_id]
-
+    
     async def send_personal_message(self, message: dict, user_id: str):
         if user_id in self.active_connections:
             for connection in self.active_connections[user_id]:
@@ -50,15 +59,35 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+# Identifies this process in user_presence
+node_id = default_worker_id()
+
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
     await manager.connect(websocket, user_id)
+    # Lets sync workers favour the accounts of connected users
+    async with AsyncSessionLocal() as db:
+        await mark_connected(db, node_id, [user_id])
+    # Bring the user's accounts up to date first
+    from app.email.service import bump_user_sync
+    await bump_user_sync(user_id)
+    if settings.IMAP_IDLE_ENABLED:
+        # Connected users get push delivery through IMAP IDLE
+        from app.email.idle import idle_manager
+        await idle_manager.watch_user(user_id)
     try:
         while True:
             # Just keep the connection open and wait for server to send updates
             await websocket.receive_text()
     except WebSocketDisconnect:
         manager.disconnect(websocket, user_id)
+        if user_id not in manager.active_connections:
+            async with AsyncSessionLocal() as db:
+                await mark_disconnected(db, node_id, user_id)
+            if settings.IMAP_IDLE_ENABLED:
+                # Sessions are only kept while the user is connected
+                from app.email.idle import idle_manager
+                await idle_manager.unwatch_user(user_id)
 
 @app.on_event("startup")
 async def startup_event():
@@ -69,9 +98,34 @@ async def startup_event():
     from app.db.migrate import migrate
     migrate()
     
-    # Start background email sync task
-    from app.email.service import background_email_sync
-    asyncio.create_task(background_email_sync())
+    # Load the trained category classifier if enabled
+    from app.email.service import load_classifier, watch_classifier
+    load_classifier()
+    # Picks up models trained by other API processes
+    app.state.classifier_watch = asyncio.create_task(watch_classifier())
+    
+    # Notifications from syncs reach the WebSockets through the database
+    app.state.notification_relay = asyncio.create_task(relay_notifications(manager, node_id))
+    
+    # Syncs run in python -m app.worker; the API only queues them unless EMBEDDED_WORKER is set
+    if settings.EMBEDDED_WORKER:
+        from app.worker import SyncWorker
+        app.state.sync_worker = asyncio.create_task(SyncWorker().run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for name in ("sync_worker", "notification_relay", "classifier_watch"):
+        task = getattr(app.state, name, None)
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    
+    if settings.IMAP_IDLE_ENABLED:
+        from app.email.idle import idle_manager
+        await idle_manager.stop()
+    
+    from app.email.service import shutdown_parse_executor
+    shutdown_parse_executor()
 
 if __name__ == "__main__":
     import uvicorn
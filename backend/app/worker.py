@@ -0,0 +1,201 @@
+"""
+Email sync worker
+
+Run with: python -m app.worker
+
+Claims sync and re-categorization jobs queued by the API from the jobs table
+and runs them, and queues sync jobs for accounts whose polling interval has
+elapsed. Several workers can run side by side, on one host or many, to sync
+more accounts at once; each one only handles the accounts in its shards (see
+app.email.sharding).
+"""
+import asyncio
+import logging
+import signal
+from datetime import timedelta
+from typing import Dict, Optional
+
+from prometheus_client import start_http_server
+
+from app.core.config import settings
+from app.db.init_db import init_db
+from app.db.models import Job
+from app.db.session import AsyncSessionLocal
+from app.email.imap import IMAP_HOST
+from app.email.jobs import (
+    RECATEGORIZE, claim_jobs, complete_job, default_worker_id, extend_leases, fail_job, purge_finished_jobs, release_job
+)
+from app.email.recategorize import run_recategorize_job
+from app.email.scheduler import SyncScheduler
+from app.email.sharding import ShardMembership
+from app.email.service import (
+    fetch_emails_for_account, load_classifier, schedule_due_accounts, shutdown_parse_executor, watch_classifier
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Finished jobs are kept this long for status queries
+FINISHED_JOB_RETENTION = timedelta(days=1)
+
+class SyncWorker:
+    """Runs claimed sync jobs through a SyncScheduler and keeps their leases alive"""
+    
+    def __init__(self, worker_id: Optional[str] = None):
+        self.worker_id = worker_id or default_worker_id()
+        self.scheduler = SyncScheduler(
+            self.run_sync_job,
+            concurrency=settings.SYNC_CONCURRENCY,
+            provider_concurrency=settings.SYNC_PROVIDER_CONCURRENCY
+        )
+        self.membership = ShardMembership(self.worker_id)
+        # Account ID of each job queued or running in this worker
+        self.running: Dict[str, str] = {}
+        # Re-categorization jobs run one at a time beside the syncs
+        self.recategorizing: Dict[str, asyncio.Task] = {}
+    
+    async def run_sync_job(self, account_id: str, user_id: str):
+        # The scheduler holds at most one job per account
+        job_id = next(job_id for job_id, job_account_id in self.running.items() if job_account_id == account_id)
+        try:
+            new_emails = await fetch_emails_for_account(account_id, user_id)
+            async with AsyncSessionLocal() as db:
+                if new_emails is None:
+                    await fail_job(db, job_id, self.worker_id, "Sync failed")
+                else:
+                    await complete_job(db, job_id, self.worker_id)
+        finally:
+            self.running.pop(job_id, None)
+    
+    async def recategorize(self, job: Job):
+        try:
+            try:
+                await run_recategorize_job(job)
+            except Exception as e:
+                async with AsyncSessionLocal() as db:
+                    await fail_job(db, job.id, self.worker_id, str(e))
+            else:
+                async with AsyncSessionLocal() as db:
+                    await complete_job(db, job.id, self.worker_id)
+        finally:
+            self.recategorizing.pop(job.id, None)
+    
+    async def consume(self):
+        """Claim jobs whenever there is room for more syncs"""
+        while True:
+            try:
+                jobs = []
+                # Every account syncs from IMAP_HOST, so no more than its limit can run;
+                # jobs claimed beyond it would only wait while holding their leases
+                limit = min(settings.SYNC_CONCURRENCY, settings.SYNC_PROVIDER_CONCURRENCY)
+                capacity = limit - len(self.running)
+                if capacity > 0:
+                    async with AsyncSessionLocal() as db:
+                        jobs = await claim_jobs(db, self.worker_id, capacity, shards=self.membership.shards)
+                    
+                    # Every account syncs from the same server, so they share its limit
+                    rejected = []
+                    for job in jobs:
+                        self.running[job.id] = job.account_id
+                        if not self.scheduler.enqueue(job.account_id, job.user_id, IMAP_HOST, job.priority):
+                            # The account's previous job has not left the scheduler yet
+                            del self.running[job.id]
+                            rejected.append(job.id)
+                    
+                    if rejected:
+                        async with AsyncSessionLocal() as db:
+                            for job_id in rejected:
+                                await release_job(db, job_id, self.worker_id)
+                
+                if not self.recategorizing:
+                    async with AsyncSessionLocal() as db:
+                        for job in await claim_jobs(db, self.worker_id, 1, kind=RECATEGORIZE):
+                            self.recategorizing[job.id] = asyncio.create_task(self.recategorize(job))
+            except Exception as e:
+                logger.error(f"Error claiming jobs: {str(e)}")
+            await asyncio.sleep(settings.JOB_POLL_SECONDS)
+    
+    async def heartbeat(self):
+        """Extend the leases of running jobs well before they expire"""
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE_SECONDS / 3)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await extend_leases(db, self.worker_id, list(self.running) + list(self.recategorizing))
+                    await purge_finished_jobs(db, FINISHED_JOB_RETENTION)
+            except Exception as e:
+                logger.error(f"Error extending job leases: {str(e)}")
+    
+    async def keep_membership(self):
+        """Heartbeat in sync_nodes several times per TTL, picking up rebalanced shards"""
+        while True:
+            await asyncio.sleep(settings.SYNC_NODE_TTL_SECONDS / 3)
+            try:
+                async with AsyncSessionLocal() as db:
+                    await self.membership.heartbeat(db)
+            except Exception as e:
+                logger.error(f"Error renewing sync node heartbeat: {str(e)}")
+    
+    async def run(self):
+        async with AsyncSessionLocal() as db:
+            await self.membership.heartbeat(db)
+        logger.info(f"Sync worker {self.worker_id} started")
+        try:
+            await asyncio.gather(
+                self.consume(), self.heartbeat(), self.keep_membership(), schedule_due_accounts(self.membership)
+            )
+        finally:
+            claimed = list(self.running) + list(self.recategorizing)
+            await self.scheduler.stop()
+            tasks = list(self.recategorizing.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            
+            # Jobs cut short are queued again right away, without counting the attempt,
+            # rather than waiting for their leases to expire
+            try:
+                async with AsyncSessionLocal() as db:
+                    for job_id in claimed:
+                        await release_job(db, job_id, self.worker_id)
+            except Exception as e:
+                logger.error(f"Error releasing claimed jobs: {str(e)}")
+            try:
+                async with AsyncSessionLocal() as db:
+                    await self.membership.leave(db)
+            except Exception as e:
+                logger.error(f"Error leaving sync nodes: {str(e)}")
+
+async def main():
+    await init_db()
+    
+    # Run database migrations
+    from app.db.migrate import migrate
+    migrate()
+    
+    # The API's /metrics only covers syncs run inside the API process
+    if settings.WORKER_METRICS_PORT:
+        try:
+            start_http_server(settings.WORKER_METRICS_PORT)
+            logger.info(f"Serving sync metrics on port {settings.WORKER_METRICS_PORT}")
+        except OSError as e:
+            logger.error(f"Cannot serve sync metrics on port {settings.WORKER_METRICS_PORT}: {str(e)}")
+    
+    # Models are trained in the API process; the worker reloads them when they change
+    load_classifier()
+    classifier_watch = asyncio.create_task(watch_classifier())
+    
+    worker = asyncio.create_task(SyncWorker().run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.cancel)
+    try:
+        await worker
+    except asyncio.CancelledError:
+        logger.info("Sync worker stopped")
+    finally:
+        classifier_watch.cancel()
+        shutdown_parse_executor()
+
+if __name__ == "__main__":
+    asyncio.run(main())